@@ -0,0 +1,220 @@
+"""
+Reading and writing many attributes at once.
+"""
+
+import anyio
+
+from .device import NoLocationKnown
+from .protocol import AttrSetMsg
+from .util import split_path
+
+try:
+    from contextlib import asynccontextmanager
+except ImportError:
+    from async_generator import asynccontextmanager
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+__all__ = ["read_many", "read_each", "write_many"]
+
+
+async def _device(service, dev):
+    if isinstance(dev, str):
+        dev = await service.get_device(dev)
+    return dev
+
+
+class _Results:
+    """Async iterator of (index, result), ends after ``n`` results"""
+
+    def __init__(self, q_r, n):
+        self._q_r = q_r
+        self._n = n
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        if not self._n:
+            raise StopAsyncIteration
+        self._n -= 1
+        return await self._q_r.receive()
+
+
+async def _read_key(dev, path, idxs, q_w):
+    try:
+        res = await dev.get(*path)
+    except Exception as exc:  # pylint: disable=broad-except
+        res = exc
+    for i in idxs:
+        await q_w.send((i, res))
+
+
+@asynccontextmanager
+async def read_each(service, items):
+    """Read many attributes concurrently.
+
+    ``items`` is a list of (device, path) tuples. A device may be given by
+    its ID; a path is a tuple or a string like ``"volt/0"``, resolved as
+    with :meth:`asyncowfs.device.Device.get`.
+
+    This is an async context manager. It returns an async iterator which
+    yields ``(index, result)`` tuples, in the order the reads complete.
+    If a read fails, its result is the exception.
+
+    All requests are submitted at once, so they're pipelined by the
+    server connection and grouped by coupler branch. The same attribute
+    is only read once, even if it's listed multiple times.
+
+    Leaving the context cancels reads that are still running.
+    """
+    groups = dict()  # (device, path) => [index]
+    for i, (dev, path) in enumerate(items):
+        dev = await _device(service, dev)
+        groups.setdefault((dev, split_path(path)), []).append(i)
+
+    q_w, q_r = anyio.create_memory_object_stream(max(len(items), 1))
+    async with anyio.create_task_group() as tg:
+        for (dev, path), idxs in groups.items():
+            await tg.spawn(_read_key, dev, path, idxs, q_w)
+        yield _Results(q_r, len(items))
+        await tg.cancel_scope.cancel()
+
+
+async def read_many(service, items):
+    """Read many attributes concurrently, see :func:`read_each`.
+
+    Returns a list with the results, in the order of ``items``. If a read
+    fails, its result is the exception.
+    """
+    res = [None] * len(items)
+    async with read_each(service, items) as results:
+        async for i, r in results:
+            res[i] = r
+    return res
+
+
+def _merge_arrays(ops):
+    """Replace writes to all elements of an array with one write to
+    the whole array, at the position of the last of them.
+
+    If an element is written more than once, the last value is used.
+    The earlier writes are dropped; they report the merged write's
+    result. Arrays that are also written as a whole aren't merged.
+
+    ``ops`` is a list of [device, path, value, indices].
+    """
+    arrays = dict()  # (device, array path) => {element: [op, …]}
+    whole = set()  # (device, path) of all writes
+    for op in ops:
+        dev, path = op[0], op[1]
+        whole.add((dev, path))
+        a = dev._array_all(path)
+        if a is None:
+            continue
+        arrays.setdefault((dev, a), dict()).setdefault(path[-1], []).append(op)
+
+    for (dev, (path, n)), elems in arrays.items():
+        if sorted(elems) != list(range(n)) or (dev, path) in whole:
+            continue
+        elem_ops = [op for e_ops in elems.values() for op in e_ops]
+        last = max(elem_ops, key=lambda op: op[3][0])
+        value = [elems[i][-1][2] for i in range(n)]
+        idxs = [i for op in elem_ops for i in op[3]]
+        for op in elem_ops:
+            op[3] = None
+        last[1:] = [path, value, sorted(idxs)]
+    return [op for op in ops if op[3] is not None]
+
+
+async def _collect(msgs, res):
+    while msgs:
+        msg, idxs = msgs[0]
+        try:
+            await msg.get_reply()
+        except Exception as exc:  # pylint: disable=broad-except
+            for i in idxs:
+                res[i] = exc
+        except BaseException:
+            for m, _ in msgs:
+                await m.cancel()
+            raise
+        msgs.pop(0)
+
+
+async def _write_bus(bus, ops, res, priority=0):
+    msgs = []
+    try:
+        for dev, path, value, idxs in ops:
+            try:
+                target = dev._write_target(path, value)
+                if target is None:
+                    # custom setter: can't pipeline this one
+                    await _collect(msgs, res)
+                    await dev.set(*path, value=value)
+                    continue
+                server = bus.server
+                if server is None:
+                    raise NoLocationKnown(bus)
+                path = (*bus.path, dev.id, *target[0])
+                if server.buffering:
+                    msg = server.buffer_write(path, target[1], priority)
+                else:
+                    msg = AttrSetMsg(*path, value=target[1])
+                    await server.submit(msg)
+                msgs.append((msg, idxs))
+            except Exception as exc:  # pylint: disable=broad-except
+                for i in idxs:
+                    res[i] = exc
+    except BaseException:
+        for m, _ in msgs:
+            await m.cancel()
+        raise
+    await _collect(msgs, res)
+
+
+async def write_many(service, items, priority: int = 0):
+    """Write many attributes.
+
+    ``items`` is a list of (device, path, value) tuples. Devices and paths
+    are as in :func:`read_each`; a path is written like
+    :meth:`asyncowfs.device.Device.set` does.
+
+    Writes to different buses run concurrently. Writes to the same bus,
+    and thus to the same device, are sent in the order given, without
+    waiting for each reply, so they're pipelined. If all elements of an
+    array on a device are written, they're combined into a single write
+    to its ``.ALL`` attribute, which is sent in place of the last of
+    them.
+
+    If a server has an offline buffer and is reconnecting, the writes
+    to it are buffered with this ``priority`` instead, see
+    :meth:`asyncowfs.server.Server.attr_set`. This waits until they have
+    been sent; they may be reordered and coalesced with other buffered
+    writes. A write that doesn't fit in the buffer fails with
+    :class:`asyncowfs.server.WriteBufferFull`.
+
+    Returns a list with one entry per item: ``None`` if the write
+    succeeded, else the exception.
+    """
+    res = [None] * len(items)
+    ops = []
+    for i, (dev, path, value) in enumerate(items):
+        ops.append([await _device(service, dev), split_path(path), value, [i]])
+    ops = _merge_arrays(ops)
+
+    buses = dict()  # bus => ops
+    for op in ops:
+        bus = op[0].bus
+        if bus is None:
+            for i in op[3]:
+                res[i] = NoLocationKnown(op[0])
+        else:
+            buses.setdefault(bus, []).append(op)
+
+    async with anyio.create_task_group() as tg:
+        for bus, b_ops in buses.items():
+            await tg.spawn(_write_bus, bus, b_ops, res, priority)
+    return res
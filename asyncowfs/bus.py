@@ -2,17 +2,75 @@
 Buses.
 """
 
-from random import random
 import anyio
+import attr
+from array import array
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
 
 from .device import NotADevice, split_id, NoLocationKnown
-from .event import BusAdded, BusDeleted, DeviceAlarm
+from .event import BusAdded, BusDeleted, BusValues, DeviceAlarm
 from .error import OWFSReplyError
+from .scheduler import MAX_BACKOFF
+
+from functools import partial
 
 import logging
 
 logger = logging.getLogger(__name__)
 
+# Delay before re-spreading polls after an interval change, so that
+# setting up many polls spreads them once
+SPREAD_DELAY = 0.5
+
+# Worst-case time until the result of a simultaneous conversion is
+# available, in seconds
+CONVERSION_DELAY = {"temperature": 0.75, "voltage": 0.01}
+
+
+@attr.s
+class BusBudgetExceeded(RuntimeError):
+    """Polling this often would exceed the bus's budget."""
+
+    bus = attr.ib()
+    utilization = attr.ib()
+
+
+@attr.s(eq=False)
+class Snapshot:
+    """The values of all devices on a bus, sampled at the same time. See
+    :meth:`Bus.snapshot`.
+
+    Values are stored by column: ``ids`` lists the device IDs, and each
+    column of ``columns`` has one 64-bit float per device, in the same
+    order. Lists of values, like the four voltages of a DS2450, get one
+    column per element, named ``voltage/0`` … ``voltage/3``. Columns are
+    NumPy arrays if NumPy is installed, else :class:`array.array`.
+
+    Values that couldn't be read are NaN. ``status`` has one entry per
+    device: ``None`` if all its reads succeeded, else the first error.
+    """
+
+    time = attr.ib()
+    ids = attr.ib()
+    columns = attr.ib()
+    status = attr.ib()
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __getitem__(self, name):
+        return self.columns[name]
+
+
+def _column(n):
+    if np is not None:
+        return np.full(n, np.nan)
+    return array("d", [float("nan")]) * n
+
 
 class Bus:
     """Describes one bus."""
@@ -25,9 +83,16 @@ class Bus:
         self._buses = dict()  # subpath => bus
         self._devices = dict()  # id => device
         self._unseen = 0  # didn't find when scanning
-        self._tasks = dict()  # polltype => task
+        self._tasks = dict()  # polltype => poll job
         self._intervals = dict()
         self._random = dict()  # varying intervals
+        self.conversion_delay = dict(CONVERSION_DELAY)
+        self._phase_base = None  # reference time for spreading polls
+        self._spread_pending = None  # periods to re-spread soon
+        self.budget = None  # max utilization
+        self.budget_policy = "stretch"
+        self.stretch = 1  # factor applied to poll intervals
+        self._budget_checked = None
 
     def __repr__(self):
         return "<%s:%s %s>" % (
@@ -45,9 +110,17 @@ class Bus:
 
     @property
     def devices(self):
-        """Iterate over the devices on this bus"""
+        """The devices on this bus.
+
+        This is a snapshot, so it's safe to await while iterating.
+        """
+        return tuple(self._device_view())
+
+    def _device_view(self):
+        """A live view of the devices on this bus; don't await while
+        iterating it."""
         try:
-            return list(self._devices.values())
+            return self._devices.values()
         except AttributeError:
             return ()
 
@@ -66,6 +139,11 @@ class Bus:
             for d in self.devices:
                 await d.delocate(bus=self)
             self._devices = None
+        for j in self._tasks.values():
+            await j.cancel()
+        self._tasks = dict()
+        if self.server._all_buses is not None:
+            self.server._all_buses.pop(self.path, None)
         await self.service.push_event(BusDeleted(self))
 
     @property
@@ -82,14 +160,16 @@ class Bus:
         except KeyError:
             bus = Bus(self.server, *self.path, *path)
             self._buses[path] = bus
+            self.server._all_buses[bus.path] = bus
             await self.service.push_event(BusAdded(bus))
             return bus
 
-    async def _scan_one(self, polling=True):
+    async def _scan_one(self, polling=True, cached=False):
         """Scan a single bus, plus all buses attached to it"""
         buses = set()
-        res = await self.dir()
+        res = await self.dir(cached=cached)
         old_devs = set(self._devices.keys())
+        changed = False
         for d in res:
             try:
                 split_id(d)  # only tests for conformity
@@ -102,22 +182,26 @@ class Bus:
                 old_devs.remove(d)
             else:
                 await self.add_device(dev)
+                changed = True
             dev._unseen = 0
             logger.debug("Found %s/%s", "/".join(self.path), d)
             for b in dev.buses():
                 buses.add(b)
                 bus = await self.get_bus(*b)
                 if bus is not None:
-                    buses.update(await bus._scan_one(polling=polling))
+                    buses.update(await bus._scan_one(polling=polling, cached=cached))
 
         for d in old_devs:
             dev = self._devices[d]
             if dev._unseen > 2:
                 await dev.delocate(self)
+                changed = True
             else:
                 dev._unseen += 1
         if polling:
             await self.update_poll()
+        if changed:
+            await self.spread_polls()
         return buses
 
     async def update_poll(self):
@@ -125,7 +209,7 @@ class Bus:
         items = set()
         intervals = dict()
         randoms = dict()
-        for dev in self.devices:
+        for dev in self._device_view():
             for k in dev.polling_items():
                 i = dev.polling_interval(k)
                 if i is None:
@@ -149,46 +233,202 @@ class Bus:
         self._intervals.update(intervals)
         self._random.update(randoms)
         for x in items:
-            if x not in self._tasks:
-                self._tasks[x] = await self.service.add_task(self._poll, x)
-
-    async def _poll(self, name):
-        """Task to run a specific poll in the background"""
-        while True:
-            i = self._intervals[name]
-            j = self._random.get(name, 0)
-            if j:
-                i *= 1 + (random() - 0.5) / j
-            logger.info("Delay %s for %f", name, i)
-            await anyio.sleep(i)
-            await self.poll(name)
+            i = self._intervals[x]
+            j = self._random.get(x, 0)
+            try:
+                job = self._tasks[x]
+            except KeyError:
+                self._tasks[x] = await self.service.add_poll(
+                    partial(self.poll, x), i, random=j, isolate=False, bus=self
+                )
+            else:
+                job.interval = i
+                job.random = j
+
+    async def spread_polls(self, periods=None):
+        """Distribute the polls on this bus evenly.
+
+        Polls with the same interval are given different phases within
+        that interval, so that they don't all hit the bus at the same
+        time. Each poll gets a slice of the interval that's proportional to
+        its measured cost.
+
+        :param periods: only spread the polls with these intervals.
+            Default: all of them.
+        """
+        if self._devices is None:
+            return
+        poller = self.service._poller
+        if self._phase_base is None:
+            self._phase_base = await anyio.current_time()
+        self.check_budget()
+
+        groups = dict()  # period => jobs
+        jobs = [self._tasks[k] for k in sorted(self._tasks)]
+        for dev in sorted(self._devices.values(), key=lambda d: d.id):
+            jobs.extend(dev._poll[k] for k in sorted(dev._poll, key=str))
+        for job in jobs:
+            if job.cancelled or job.period <= 0:
+                continue
+            if periods is not None and job.period not in periods:
+                continue
+            groups.setdefault(job.period, []).append(job)
+
+        for interval, jobs in groups.items():
+            costs = [j.cost for j in jobs if j.cost]
+            default = sum(costs) / len(costs) if costs else 1
+            costs = [j.cost or default for j in jobs]
+            total = sum(costs)
+            offset = 0
+            for job, cost in zip(jobs, costs):
+                await poller.align(job, self._phase_base + interval * offset / total)
+                offset += cost
+
+    async def request_spread(self, *periods):
+        """Spread the polls with these intervals soon, see
+        :meth:`spread_polls`.
+
+        Requests made within :data:`SPREAD_DELAY` seconds are combined, so
+        changing many intervals re-spreads each group only once.
+        """
+        if self._spread_pending is not None:
+            self._spread_pending.update(periods)
+            return
+        self._spread_pending = set(periods)
+        await self.service.nursery.spawn(self._delayed_spread)
+
+    async def _delayed_spread(self):
+        await anyio.sleep(SPREAD_DELAY)
+        periods, self._spread_pending = self._spread_pending, None
+        await self.spread_polls(periods)
+
+    # ##### Bus bandwidth budget ##### #
+
+    def _jobs(self):
+        yield from self._tasks.values()
+        for dev in self._device_view():
+            yield from dev._poll.values()
+
+    def _default_cost(self):
+        costs = [j.bus_cost for j in self._jobs() if j.bus_cost is not None]
+        return sum(costs) / len(costs) if costs else 0
+
+    @property
+    def utilization(self):
+        """The fraction of time this bus would be busy polling, at the
+        configured intervals.
+
+        This is estimated from the time owserver took to answer each
+        poll's requests; waiting for a conversion doesn't count. Polls that
+        haven't run yet are assumed to take as long as the average.
+        Multiply by 1000 for bus milliseconds per second.
+        """
+        default = None
+        res = 0
+        for job in self._jobs():
+            if job.cancelled or job.interval <= 0:
+                continue
+            cost = job.bus_cost
+            if cost is None:
+                if default is None:
+                    default = self._default_cost()
+                cost = default
+            res += cost / job.interval
+        return res
+
+    def set_budget(self, budget, policy="stretch"):
+        """Limit polling on this bus.
+
+        :param budget: the maximum :attr:`utilization`, e.g. 0.5 for 500
+            bus milliseconds per second. ``None`` removes the limit.
+        :param policy: "stretch" to lengthen all poll intervals on this
+            bus proportionally when the budget is exceeded; "refuse" to
+            raise :class:`BusBudgetExceeded` when a device's polling
+            interval is set to a value that would exceed it.
+        """
+        if policy not in ("stretch", "refuse"):
+            raise ValueError(policy)
+        self.budget = budget
+        self.budget_policy = policy
+        self.check_budget()
+
+    def check_budget(self):
+        """Recalculate the factor by which poll intervals are stretched."""
+        stretch = 1
+        if self.budget and self.budget_policy == "stretch":
+            stretch = max(1, self.utilization / self.budget)
+        if stretch != self.stretch:
+            if stretch > 1:
+                logger.info("%s: polling slowed by %.2f", self, stretch)
+            self.stretch = stretch
+        for job in self._jobs():
+            job.stretch = stretch
+
+    def job_done(self, job, now):  # pylint: disable=unused-argument
+        """Called by the poll scheduler after a poll on this bus ran.
+
+        Re-checks the budget at most once a second.
+        """
+        if not self.budget or self._devices is None:
+            return
+        if self._budget_checked is not None and now - self._budget_checked < 1:
+            return
+        self._budget_checked = now
+        self.check_budget()
+
+    def admit(self, dev, typ, interval):
+        """Check whether polling ``typ`` on ``dev`` every ``interval``
+        seconds fits this bus's budget.
+
+        :raises BusBudgetExceeded: if not, and the policy is "refuse".
+        """
+        if not self.budget or self.budget_policy != "refuse" or not interval:
+            return
+        if hasattr(dev, "poll_" + typ):
+            job = self._tasks.get(typ)
+            if job is not None:
+                interval = min(interval, job.interval)
+        else:
+            job = dev._poll.get(typ)
+        if job is not None and job.bus_cost is not None:
+            cost = job.bus_cost
+        else:
+            cost = self._default_cost()
+        util = self.utilization + cost / interval
+        if job is not None and not job.cancelled and job.interval > 0:
+            util -= cost / job.interval
+        if util > self.budget:
+            raise BusBudgetExceeded(self, util)
 
     async def add_device(self, dev):
         await dev.locate(self)
         self._devices[dev.id] = dev
+        self.service._registry.locate(dev, self)
 
     async def _del_device(self, dev):
         del self._devices[dev.id]
 
-    def dir(self, *subpath):
-        return self.server.dir(*self.path, *subpath)
+    def dir(self, *subpath, cached=False):
+        return self.server.dir(*self.path, *subpath, cached=cached)
 
     async def attr_get(self, *attr):
         """Read this attribute"""
         return await self.server.attr_get(*self.path, *attr)
 
-    async def attr_set(self, *attr, value):
-        """Write this attribute"""
+    async def attr_set(self, *attr, value, **kw):
+        """Write this attribute. See :meth:`asyncowfs.server.Server.attr_set`
+        for the keyword arguments."""
         if self.server is None:
             raise NoLocationKnown(self)
-        return await self.server.attr_set(*self.path, *attr, value=value)
+        return await self.server.attr_set(*self.path, *attr, value=value, **kw)
 
     # ##### Support for polling and alarm handling ##### #
 
-    async def poll(self, name):
+    async def poll(self, name, late=0):
         """Run one poll.
 
-        This typically runs via a :meth:`_poll` task, started by :meth:`update_poll`.
+        This typically runs via the service's poll scheduler, set up by
+        :meth:`update_poll`, which passes in how ``late`` the poll is.
         """
         try:
             try:
@@ -199,11 +439,12 @@ class Bus:
                     if p is not None:
                         await p()
             else:
-                await p()
+                await p(late=late)
         except OWFSReplyError:
             logger.exception("Poll '%s' on %s", name, self)
+            return False
 
-    async def poll_alarm(self):
+    async def poll_alarm(self, late=0):  # pylint: disable=unused-argument
         """Scan the 'alarm' subdirectory"""
         for dev in await self.dir("alarm"):
             dev = await self.service.get_device(dev)
@@ -211,23 +452,149 @@ class Bus:
             reasons = await dev.poll_alarm()
             await self.service.push_event(DeviceAlarm(dev, reasons))
 
-    async def _poll_simul(self, name, delay):
-        """Write to a single 'simultaneous' entry"""
+    async def _poll_simul(self, name, late=0):
+        """Write to a single 'simultaneous' entry, wait for the conversion
+        to finish, then read the results of all devices on this bus
+        which are polled for ``name``.
+
+        The results are read in parallel, so they're pipelined. If the
+        service's ``aggregate_polls`` option is set, they're sent as one
+        :class:`asyncowfs.event.BusValues` event.
+
+        A device whose read fails is skipped for 1, 3, 7, … polls (up to
+        :data:`asyncowfs.scheduler.MAX_BACKOFF`) after consecutive errors.
+        """
+        devs = []
+        for d in self._device_view():
+            if not hasattr(d, "simul_" + name) or d.polling_interval(name) is None:
+                continue
+            skip = d._simul_skip.get(name, 0)
+            if skip:
+                d._simul_skip[name] = skip - 1
+                continue
+            devs.append(d)
+        if not devs:
+            return
         await self.attr_set("simultaneous", name, value=1)
+        await anyio.sleep(self._simul_delay(name, devs))
+        values = dict() if self.service.aggregate_polls else None
+        async with anyio.create_task_group() as tg:
+            for dev in devs:
+                await tg.spawn(self._read_simul, dev, name, late, values)
+        if values:
+            await self.service.push_event(BusValues(self, name, values, late=late))
+
+    async def _read_simul(self, dev, name, late=0, values=None):
+        try:
+            v = await getattr(dev, "simul_" + name)()
+        except Exception as exc:  # pylint: disable=broad-except
+            logger.exception("Reader at %s %s", dev, name)
+            n = dev._simul_errors.get(name, 0) + 1
+            dev._simul_errors[name] = n
+            dev._simul_skip[name] = min(2 ** n, MAX_BACKOFF) - 1
+            await dev.push_error(name, exc)
+        else:
+            dev._simul_errors.pop(name, None)
+            if values is None:
+                await dev.push_value(name, v, late=late)
+            elif await dev.accept_value(name, v):
+                values[dev] = v
+
+    async def snapshot(self, attributes=("temperature",)):
+        """Sample all devices on this bus at the same time.
+
+        For each attribute ("temperature", "voltage"), a single
+        simultaneous conversion is started. After the longest of their
+        conversion delays, the results of all devices that support it are
+        read in parallel, whether they're polled or not. No events are
+        sent.
+
+        :param attributes: an attribute name, or a list of them.
+        :return: a :class:`Snapshot`, timestamped when the conversions
+            have finished.
+        """
+        if isinstance(attributes, str):
+            attributes = (attributes,)
+        for name in attributes:
+            if name not in self.conversion_delay:
+                raise KeyError(name)
+        devs = sorted(
+            (d for d in self._device_view() if any(hasattr(d, "simul_" + n) for n in attributes)),
+            key=lambda d: d.id,
+        )
+        names = [n for n in attributes if any(hasattr(d, "simul_" + n) for d in devs)]
+        for name in names:
+            await self.attr_set("simultaneous", name, value=1)
+        delay = 0
+        for name in names:
+            ndevs = [d for d in devs if hasattr(d, "simul_" + name)]
+            delay = max(delay, self._simul_delay(name, ndevs))
         await anyio.sleep(delay)
-        for dev in self.devices:
-            try:
-                p = getattr(dev, "poll_" + name)
-            except AttributeError:
-                pass
+        t = await anyio.current_time()
+
+        values = dict()  # (device index, name) => value
+        status = [None] * len(devs)
+        async with anyio.create_task_group() as tg:
+            for i, dev in enumerate(devs):
+                for name in names:
+                    if hasattr(dev, "simul_" + name):
+                        await tg.spawn(self._read_snapshot, i, dev, name, values, status)
+
+        columns = dict()
+        for name in names:
+            lists = [
+                v for (_, n), v in values.items() if n == name and isinstance(v, (list, tuple))
+            ]
+            if lists:
+                cols = ["%s/%d" % (name, k) for k in range(max(len(v) for v in lists))]
             else:
-                await p()
+                cols = [name]
+            cols = [columns.setdefault(c, _column(len(devs))) for c in cols]
+            for (i, n), v in values.items():
+                if n != name:
+                    continue
+                if not lists:
+                    v = (v,)
+                for c, x in zip(cols, v):
+                    try:
+                        c[i] = float(x)
+                    except (TypeError, ValueError):
+                        pass
+        return Snapshot(t, [d.id for d in devs], columns, status)
+
+    async def _read_snapshot(self, i, dev, name, values, status):
+        try:
+            values[i, name] = await getattr(dev, "simul_" + name)()
+        except Exception as exc:  # pylint: disable=broad-except
+            if status[i] is None:
+                status[i] = exc
 
+    def _simul_delay(self, name, devs):
+        """How long to wait for a simultaneous conversion of these devices.
+
+        If every device knows its conversion time, the longest one is
+        used; otherwise the bus's ``conversion_delay``.
+        """
+        delay = 0
+        for d in devs:
+            dd = d.simul_delay(name)
+            if dd is None:
+                return self.conversion_delay[name]
+            delay = max(delay, dd)
+        return delay
+
+    def set_conversion_delay(self, name, delay):
+        """Change how long to wait for a simultaneous conversion of type
+        ``name`` ("temperature", "voltage") to finish on this bus.
+        """
+        if name not in self.conversion_delay:
+            raise KeyError(name)
+        self.conversion_delay[name] = delay
 
-#   def poll_temperature(self):
-#       """Read all temperature data"""
-#       return self._poll_simul("temperature", 1.2)
+    async def poll_temperature(self, late=0):
+        """Read all temperature data, using a simultaneous conversion"""
+        await self._poll_simul("temperature", late)
 
-#   def poll_voltage(self):
-#       """Read all voltage data"""
-#       return self._poll_simul("voltage", 1.2)
+    async def poll_voltage(self, late=0):
+        """Read all voltage data, using a simultaneous conversion"""
+        await self._poll_simul("voltage", late)
@@ -4,10 +4,15 @@ Devices.
 
 import attr
 import anyio
+from inspect import getattr_static
 from typing import List
+from functools import partial
 
 from .event import DeviceLocated, DeviceNotFound, DeviceValue, DeviceException
-from .error import IsDirError
+from .error import IsDirError, OWFSReplyError
+from .policy import ValueFilter, AdaptiveInterval, WriteCoalescer
+from .subscription import Watch
+from .util import split_path
 
 import logging
 
@@ -31,6 +36,7 @@ dev_classes = dict()
 
 def register(cls):
     dev_classes[cls.family] = cls
+    return cls
 
 
 def split_id(id):  # pylint: disable=redefined-builtin
@@ -100,7 +106,12 @@ class SimpleSetter(_WValue):
 
     def __get__(slf, self, cls):  # pylint: disable=no-self-argument
         async def setter(val):
-            await self.dev.attr_set(*slf.path, value=slf.conv(val))
+            val = slf.conv(val)
+            c = self.dev._coalescers.get(slf.path)
+            if c is None:
+                await self.dev.attr_set(*slf.path, value=val)
+            else:
+                await c.write(val)
 
         return setter
 
@@ -146,30 +157,28 @@ class _IdxObj:
         self.dev = dev
         self.ary = ary
 
-    async def __getitem__(self, idx):
+    def _path(self, idx):
         if self.ary.num:
             idx = str(idx)
         else:
             idx = chr(ord("A") + idx)
-        p = self.ary.path[:-1] + (self.ary.path[-1] + "." + idx,)
-        res = await self.dev.attr_get(*p)
+        return self.ary.path[:-1] + (self.ary.path[-1] + "." + idx,)
+
+    async def __getitem__(self, idx):
+        res = await self.dev.attr_get(*self._path(idx))
         return self.ary.conv(res)
 
     async def set(self, idx, val):
-        if self.ary.num:
-            idx = str(idx)
-        else:
-            idx = chr(ord("A") + idx)
-        p = self.ary.path[:-1] + (self.ary.path[-1] + "." + idx,)
-        await self.dev.attr_set(*p, value=val)
+        await self.dev.attr_set(*self._path(idx), value=val)
 
 
 class ArrayValue(_RValue):
     """Accessor for direct array element access"""
 
-    def __init__(self, path, typ, num):
+    def __init__(self, path, typ, num, elements=None):
         super().__init__(path, typ)
         self.num = num
+        self.elements = elements
 
     def __get__(slf, self, cls):  # pylint: disable=no-self-argument
         return _IdxObj(self.dev, slf)
@@ -300,7 +309,7 @@ async def setup_accessors(server, cls, typ, *subdir):
                         if hasattr(cls, d):
                             logger.debug("%s: not overwriting %s", cls, d)
                         else:
-                            setattr(cls, d, ArrayValue(dd, v[0], num))
+                            setattr(cls, d, ArrayValue(dd, v[0], num, v[2]))
                         setattr(cls, "get_" + d, ArrayGetter(dd, v[0], num))
                     if v[3] in {"wo", "rw"}:
                         setattr(cls, "set_" + d, ArraySetter(dd, v[0], num))
@@ -354,8 +363,15 @@ class Device(SubDir):
         self._unseen = 0
         self._events = []
         self._wait_bus = anyio.create_event()
-        self._poll = {}  # name > poll task scopes
+        self._poll = {}  # name > poll jobs
         self._intervals = {}
+        self._filters = {}  # name > ValueFilter
+        self._adaptive = {}  # name > AdaptiveInterval
+        self.suppressed = {}  # name > number of values not reported
+        self._simul_errors = {}  # name > consecutive errors
+        self._simul_skip = {}  # name > number of simultaneous polls to skip
+        self._coalescers = {}  # raw path > WriteCoalescer
+        self._watches = {}  # path > [PollJob, [Watch]]
         self._task_lock = anyio.create_lock()
 
         return self
@@ -421,7 +437,14 @@ class Device(SubDir):
         await self._wait_bus.set()
         await self.service.push_event(DeviceLocated(self))
         for typ, val in self._intervals.items():
+            if hasattr(self, "poll_" + typ):
+                continue  # the bus handles this
             await self._set_poll_task(typ, val)
+        for path, w in self._watches.items():
+            if w[0] is not None and w[0].bus is not bus:
+                await w[0].cancel()
+                w[0] = None
+            await self._update_watch(path)
 
     async def wait_bus(self):
         await self._wait_bus.wait()
@@ -434,10 +457,15 @@ class Device(SubDir):
 
     async def _delocate(self):
         await self.bus._del_device(self)
+        self.service._registry.delocate(self)
         self.bus = None
         for t in self._poll.values():
             await t.cancel()
         self._poll = {}
+        for w in self._watches.values():
+            if w[0] is not None:
+                await w[0].cancel()
+                w[0] = None
         await self.service.push_event(DeviceNotFound(self))
 
     async def attr_get(self, *attrs: List[str]):
@@ -446,11 +474,12 @@ class Device(SubDir):
             raise NoLocationKnown(self)
         return await self.bus.attr_get(self.id, *attrs)
 
-    async def attr_set(self, *attrs: List[str], value):
-        """Write this attribute (ignoring device struct)"""
+    async def attr_set(self, *attrs: List[str], value, **kw):
+        """Write this attribute (ignoring device struct). See
+        :meth:`asyncowfs.server.Server.attr_set` for the keyword arguments."""
         if self.bus is None:
             raise NoLocationKnown(self)
-        return await self.bus.attr_set(self.id, *attrs, value=value)
+        return await self.bus.attr_set(self.id, *attrs, value=value, **kw)
 
     async def get(self, *attrs):
         """Read this attribute (following device struct)"""
@@ -462,6 +491,51 @@ class Device(SubDir):
                 dev = getattr(dev, k)
         return await dev
 
+    async def get_many(self, *paths):
+        """Read these attributes concurrently.
+
+        Each path is a tuple or a string like ``"volt/0"``. Returns the
+        results in order; a failed read's result is its exception.
+        """
+        return await self.service.read_many([(self, p) for p in paths])
+
+    def _write_target(self, attrs, value):
+        """Return the raw path and value that :meth:`set` would write,
+        or ``None`` if that's not a plain structure accessor."""
+        obj = self
+        for k in attrs[:-1]:
+            if isinstance(k, int):
+                return None
+            obj = getattr(obj, k)
+        k = attrs[-1]
+        if isinstance(obj, _IdxObj):
+            return obj._path(k), value
+        w = getattr_static(obj, "set_" + k, None)
+        if isinstance(w, MultiSetter):
+            p = w.path[:-1] + (w.path[-1] + ".ALL",)
+            return p, b",".join(w.conv(v) for v in value)
+        if isinstance(w, SimpleSetter):
+            return w.path, w.conv(value)
+        return None
+
+    def _array_all(self, attrs):
+        """If ``attrs`` addresses an element of an array that can be
+        written as a whole, return that array's path for :meth:`set` and
+        its number of elements. Otherwise return ``None``."""
+        if len(attrs) < 2 or not isinstance(attrs[-1], int):
+            return None
+        obj = self
+        for k in attrs[:-2]:
+            if isinstance(k, int):
+                return None
+            obj = getattr(obj, k)
+        ary = getattr_static(obj, attrs[-2], None)
+        if not isinstance(ary, ArrayValue) or not ary.elements:
+            return None
+        if not isinstance(getattr_static(obj, "set_" + attrs[-2] + "_all", None), MultiSetter):
+            return None
+        return attrs[:-2] + (attrs[-2] + "_all",), ary.elements
+
     async def set(self, *attrs, value):
         """Write this attribute (following device struct)"""
         dev = self
@@ -475,6 +549,110 @@ class Device(SubDir):
         else:
             await getattr(dev, "set_" + attrs[-1])(value)
 
+    def set_write_coalescing(self, *attrs, enable: bool = True, spacing: float = 0):
+        """Coalesce writes to this attribute: while a write is in flight,
+        later values replace each other instead of queueing up, see
+        :class:`asyncowfs.policy.WriteCoalescer`. Useful for outputs that
+        are driven by sliders or control loops.
+
+        :param spacing: the minimum time between two writes.
+        :param enable: set to ``False`` to write every value again.
+        :return: the :class:`asyncowfs.policy.WriteCoalescer`, which
+            counts the writes.
+
+        Only attributes with a plain ``set_*`` accessor can be coalesced.
+        :func:`asyncowfs.bulk.write_many` is not affected.
+        """
+        obj = self
+        for k in attrs[:-1]:
+            obj = obj[k] if isinstance(k, int) else getattr(obj, k)
+        w = getattr_static(obj, "set_" + attrs[-1], None)
+        if not isinstance(w, SimpleSetter):
+            raise RuntimeError("%r: No simple setter for %s" % (self, attrs))
+        if not enable:
+            self._coalescers.pop(w.path, None)
+            return None
+        c = self._coalescers.get(w.path)
+        if c is None:
+            c = self._coalescers[w.path] = WriteCoalescer(
+                partial(self._write_coalesced, w.path), self.service.nursery.spawn, spacing
+            )
+        else:
+            c.spacing = spacing
+        return c
+
+    async def _write_coalesced(self, path, value):
+        await self.attr_set(*path, value=value)
+
+    def watch(self, path, interval: float):
+        """Watch this attribute, polling it every ``interval`` seconds.
+
+        ``path`` is a tuple or a string like ``"volt/0"``. Returns a
+        :class:`asyncowfs.subscription.Watch`; use it as an async context
+        manager, then iterate over it.
+
+        Watches of the same attribute share one poll, which stops when the
+        last watch ends. It doesn't send events and is independent of
+        :meth:`set_polling_interval`. While the device's location is
+        unknown, the poll is paused.
+        """
+        return Watch(self, split_path(path), interval)
+
+    async def _add_watch(self, w):
+        self._watches.setdefault(w.path, [None, []])[1].append(w)
+        await self._update_watch(w.path, new=w.interval)
+
+    async def _del_watch(self, w):
+        job, watches = self._watches[w.path]
+        watches.remove(w)
+        if not watches:
+            del self._watches[w.path]
+            if job is not None:
+                await job.cancel()
+            return
+        await self._update_watch(w.path)
+
+    async def _update_watch(self, path, new=None):
+        w = self._watches[path]
+        interval = min(x.interval for x in w[1])
+        job = w[0]
+        if job is not None and not job.cancelled:
+            if interval >= job.interval or new is None:
+                job.interval = interval
+                return
+            await job.cancel()
+            w[0] = None
+        if self.bus is None:
+            return  # started by locate
+        # a new, faster watcher, or the device has been found: start polling now
+        w[0] = await self.service.add_poll(
+            partial(self._watch_poll, path), interval, first=0, bus=self.bus
+        )
+
+    async def _watch_poll(self, path, late=0):  # pylint: disable=unused-argument
+        """Read a watched attribute once. Called by the poll scheduler."""
+        w = self._watches.get(path)
+        if w is None or self.bus is None:
+            return None
+        try:
+            v = await self.get(*path)
+        except Exception as exc:  # pylint: disable=broad-except
+            v = exc
+        for x in w[1]:
+            await x._send(v)
+        return not isinstance(v, Exception)
+
+    def simul_delay(self, name):  # pylint: disable=unused-argument
+        """Return how long a simultaneous conversion of type ``name``
+        takes on this device, or ``None`` if unknown. The bus then uses
+        its ``conversion_delay``."""
+        return None
+
+    async def _close_watches(self):
+        for _, watches in list(self._watches.values()):
+            for w in watches:
+                await w._close()
+
     def polling_items(self):
         """Enumerate poll variants supported by this device.
 
@@ -495,29 +673,94 @@ class Device(SubDir):
     def polling_interval(self, typ: str):
         """Return the interval WRT how often to poll for this type.
 
-        The default implementation looks up the "interval_<typ>" attribute
+        The default implementation returns the current adaptive interval,
+        if one is set, else looks up the "interval_<typ>" attribute
         or returns ``None`` if that doesn't exist.
         """
+        try:
+            return self._adaptive[typ].interval
+        except KeyError:
+            pass
         try:
             return self._intervals[typ]
         except KeyError:
             return getattr(self, "interval_" + typ, None)
 
-    async def set_polling_interval(self, typ: str, value: float = 0):
+    async def set_polling_interval(
+        self,
+        typ: str,
+        value: float = 0,
+        *,
+        deadband: float = None,
+        rel_deadband: float = None,
+        on_change: bool = False,
+        heartbeat: float = None,
+        min_interval: float = None,
+        max_interval: float = None,
+        step: float = None
+    ):
+        """Poll this attribute every ``value`` seconds. Zero turns
+        polling off.
+
+        ``deadband``, ``rel_deadband``, ``on_change`` and ``heartbeat``
+        control which values are reported as
+        :class:`asyncowfs.event.DeviceValue` events, see
+        :class:`asyncowfs.policy.ValueFilter`. Values that are not
+        reported are counted in ``suppressed``.
+
+        If ``min_interval`` and ``max_interval`` are set, the interval
+        adapts to how fast the value changes, starting at ``value``, see
+        :class:`asyncowfs.policy.AdaptiveInterval`. ``step`` defaults to
+        the deadband. Use :meth:`effective_interval` to find the current
+        interval.
+
+        :raises asyncowfs.bus.BusBudgetExceeded: if the device's bus has a
+            budget with the "refuse" policy, and polling this often would
+            exceed it.
+        """
         if isinstance(typ, str):
             styp = typ
         else:
             styp = "/".join(str(x) for x in typ)
+        old_period = self.effective_interval(typ)
         if value > 0:
+            if self.bus is not None:
+                self.bus.admit(self, styp, value)
+            if min_interval is not None or max_interval is not None:
+                a = AdaptiveInterval(
+                    value,
+                    min_interval or value,
+                    max_interval or value,
+                    step=(deadband or 0) if step is None else step,
+                )
+                self._adaptive[styp] = a
+                value = a.interval
+            else:
+                self._adaptive.pop(styp, None)
             self._intervals[styp] = value
+            f = ValueFilter(
+                deadband=deadband,
+                rel_deadband=rel_deadband,
+                on_change=on_change,
+                heartbeat=heartbeat,
+            )
+            if f.active:
+                self._filters[styp] = f
+            else:
+                self._filters.pop(styp, None)
         else:
             self._intervals.pop(styp, None)
+            self._filters.pop(styp, None)
+            self._adaptive.pop(styp, None)
 
         if self.bus is not None:
             if hasattr(self, "poll_" + styp):
                 await self.bus.update_poll()
             else:
                 await self._set_poll_task(typ, value)
+            periods = {old_period, self.effective_interval(typ)} - {None}
+            if periods:
+                await self.bus.request_spread(*periods)
 
     async def _set_poll_task(self, typ, value):
         async with self._task_lock:
@@ -538,25 +781,94 @@ class Device(SubDir):
                 else:
                     s = getattr(s, pp)
             if isinstance(n, int) or hasattr(s, "get_" + n):
-                self._poll[typ] = await self.service.add_task(self._poll_task, s, n, typ, value)
+                self._poll[typ] = await self.service.add_poll(
+                    partial(self._poll_one, s, n, typ), value, first=value / 5, bus=self.bus
+                )
 
             else:
                 raise RuntimeError("%r: No poll for %s" % (self, typ))
 
-    async def _poll_task(self, s, n, typ, value):
-        await anyio.sleep(value / 5)
-        while True:
-            try:
-                if isinstance(n, int):
-                    v = await s[n]
-                else:
-                    v = await getattr(s, n)
-            except Exception as exc:
-                logger.exception("Reader at %s %s", self, typ)
-                await self.service.push_event(DeviceException(self, typ, exc))
+    async def _poll_one(self, s, n, typ, late=0):
+        """Read a polled attribute once. Called by the poll scheduler."""
+        try:
+            if isinstance(n, int):
+                v = await s[n]
             else:
-                await self.service.push_event(DeviceValue(self, typ, v))
-            await anyio.sleep(value)
+                v = await getattr(s, n)
+        except Exception as exc:  # pylint: disable=broad-except
+            logger.exception("Reader at %s %s", self, typ)
+            await self.push_error(typ, exc)
+            return False
+        else:
+            await self.push_value(typ, v, late=late)
+
+    def effective_interval(self, typ):
+        """Return the interval this attribute is currently polled at, or
+        ``None`` if it isn't.
+
+        This may be shorter than :meth:`polling_interval` if the attribute
+        is read by a bus-wide poll that another device needs more often.
+        """
+        job = self._poll.get(typ)
+        if job is None and self.bus is not None:
+            styp = typ if isinstance(typ, str) else "/".join(str(x) for x in typ)
+            if hasattr(self, "poll_" + styp):
+                job = self.bus._tasks.get(styp)
+        if job is None or job.cancelled:
+            return None
+        return job.period
+
+    @property
+    def effective_intervals(self):
+        """A dict with the effective interval of each polled attribute."""
+        res = {}
+        for typ in self._intervals:
+            i = self.effective_interval(typ)
+            if i is not None:
+                res[typ] = i
+        return res
+
+    async def _adapt(self, typ, styp, value):
+        a = self._adaptive.get(styp)
+        if a is None:
+            return
+        i = a.update(value)
+        if i is None:
+            return
+        self._intervals[styp] = i
+        if self.bus is None:
+            return
+        if hasattr(self, "poll_" + styp):
+            await self.bus.update_poll()
+        else:
+            job = self._poll.get(typ)
+            if job is not None:
+                job.interval = i
+
+    async def accept_value(self, typ, value):
+        """Process a polled value. Return ``False`` if its filter
+        suppresses it."""
+        styp = typ if isinstance(typ, str) else "/".join(str(x) for x in typ)
+        await self._adapt(typ, styp, value)
+        f = self._filters.get(styp)
+        if f is not None and not f.check(value, await anyio.current_time()):
+            self.suppressed[styp] = self.suppressed.get(styp, 0) + 1
+            return False
+        return True
+
+    async def push_value(self, typ, value, late=0):
+        """Report a polled value, unless its filter suppresses it."""
+        if await self.accept_value(typ, value):
+            await self.service.push_event(DeviceValue(self, typ, value, late=late))
+
+    async def push_error(self, typ, exc):
+        """Report a polling error. The next value is reported
+        unconditionally."""
+        styp = typ if isinstance(typ, str) else "/".join(str(x) for x in typ)
+        f = self._filters.get(styp)
+        if f is not None:
+            f.reset()
+        await self.service.push_event(DeviceException(self, typ, exc))
 
     async def poll_alarm(self):
         """Tells the device not to trigger an alarm any more.
@@ -592,9 +904,8 @@ class SwitchDevice(Device):
         # await self.set_clearalarm(1)
 
 
-@register
-class TemperatureDevice(Device):
-    family = 0x10
+class _TemperatureDevice(Device):
+    """Common code for temperature sensors."""
 
     interval_temperature = None
     alarm_temperature = None
@@ -620,20 +931,146 @@ class TemperatureDevice(Device):
         yield "alarm"
 
     async def poll_temperature(self):
-        # t = await self.latesttemp
+        """Convert and read this sensor's temperature."""
         t = await self.temperature
-        await self.service.push_event(DeviceValue(self, "temperature", t))
+        await self.push_value("temperature", t)
 
+    async def simul_temperature(self):
+        """Return the result of a simultaneous conversion."""
+        return await self.latesttemp
 
-#   @property
-#   def temperature(self):
-#       return self.latesttemp
+
+@register
+class TemperatureDevice(_TemperatureDevice):
+    family = 0x10
 
 
 @register
-class TemperatureBDevice(Device):
+class TemperatureBDevice(_TemperatureDevice):
+    """DS18B20 and compatibles.
+
+    These sensors have a configurable resolution, which trades precision
+    for conversion time. The resolution is set by reading
+    ``temperature9`` … ``temperature12``. If ``resolution`` is set, by
+    :meth:`set_resolution` or by polling with a ``precision``, that
+    attribute is read, and simultaneous conversions only wait as long as
+    the resolution requires. Otherwise the sensor's configuration is left
+    alone.
+
+    Parasite-powered sensors (``power`` is 0) can't take part in a
+    simultaneous conversion; when the bus polls, they're converted and
+    read one by one instead.
+    """
+
     family = 0x28
 
+    # bits => (precision in °C, conversion time in seconds)
+    RESOLUTIONS = {9: (0.5, 0.094), 10: (0.25, 0.188), 11: (0.125, 0.375), 12: (0.0625, 0.75)}
+
+    resolution = None
+    _applied_resolution = None  # the resolution the sensor is known to use
+    _powered = None
+
+    @classmethod
+    def pick_resolution(cls, precision: float = None, interval: float = None):
+        """Return the lowest resolution that resolves ``precision`` degrees,
+        or the highest one if that's ``None``.
+
+        If ``interval`` is set, the resolution is reduced, if necessary,
+        so that a conversion takes at most half of it.
+        """
+        bits = sorted(cls.RESOLUTIONS)
+        if precision is not None:
+            bits = [b for b in bits if cls.RESOLUTIONS[b][0] <= precision] or bits[-1:]
+            res = bits[0]
+        else:
+            res = bits[-1]
+        if interval:
+            while res > min(cls.RESOLUTIONS) and cls.RESOLUTIONS[res][1] > interval / 2:
+                res -= 1
+            if precision is not None and cls.RESOLUTIONS[res][0] > precision:
+                logger.warning(
+                    "%s: polling every %ss limits precision to %s",
+                    cls.__name__,
+                    interval,
+                    cls.RESOLUTIONS[res][0],
+                )
+        return res
+
+    def set_resolution(self, bits: int = None):
+        """Use this resolution from now on. It's sent to the sensor with
+        the next read. ``None`` leaves the sensor's configuration alone,
+        and forgets which resolution it was set to."""
+        if bits is not None and bits not in self.RESOLUTIONS:
+            raise ValueError(bits)
+        if bits is None:
+            self._applied_resolution = None
+        self.resolution = bits
+
+    async def set_polling_interval(
+        self, typ: str, value: float = 0, *, precision: float = None, **kw
+    ):
+        """Poll this attribute every ``value`` seconds, see
+        :meth:`Device.set_polling_interval`.
+
+        When polling the temperature, the resolution is chosen from
+        ``precision`` (in °C) and the interval, see
+        :meth:`pick_resolution`. Without ``precision``, a resolution set
+        earlier is reduced if the interval is too short for it.
+        """
+        if typ == "temperature" and value > 0:
+            if precision is not None:
+                self.set_resolution(self.pick_resolution(precision, value))
+            elif self.resolution is not None:
+                self.set_resolution(min(self.resolution, self.pick_resolution(None, value)))
+        await super().set_polling_interval(typ, value, **kw)
+
+    async def _read_resolution(self):
+        """Convert and read the temperature at the current resolution."""
+        bits = self.resolution
+        if bits is None:
+            return await self.temperature
+        t = await getattr(self, "temperature%d" % bits)
+        self._applied_resolution = bits
+        return t
+
+    async def poll_temperature(self):
+        """Convert and read this sensor's temperature."""
+        t = await self._read_resolution()
+        await self.push_value("temperature", t)
+
+    async def is_powered(self):
+        """Return whether the sensor has its own power supply. If that
+        can't be determined, assume it does."""
+        if self._powered is None:
+            try:
+                self._powered = await self.power
+            except OWFSReplyError as exc:
+                logger.debug("%s: no power info: %r", self, exc)
+                self._powered = True
+        return self._powered
+
+    def simul_delay(self, name):
+        if name != "temperature":
+            return None
+        if self._powered is False:
+            return 0  # not converted simultaneously
+        if self.resolution is None:
+            return None
+        if self._applied_resolution != self.resolution:
+            return 0  # will be converted by itself, see simul_temperature
+        return self.RESOLUTIONS[self.resolution][1]
+
+    async def simul_temperature(self):
+        """Return the result of a simultaneous conversion.
+
+        If the sensor is parasite-powered, or its resolution has changed,
+        it's converted and read by itself instead.
+        """
+        if not await self.is_powered() or self._applied_resolution != self.resolution:
+            return await self._read_resolution()
+        return await self.latesttemp
+
 
 @register
 class VoltageDevice(Device):
@@ -677,8 +1114,13 @@ class VoltageDevice(Device):
         yield "alarm"
 
     async def poll_voltage(self):
+        """Convert and read all four inputs."""
         v = await self.volt_all
-        await self.service.push_event(DeviceValue(self, "volt_all", v))
+        await self.push_value("voltage", v)
+
+    async def simul_voltage(self):
+        """Return the result of a simultaneous conversion."""
+        return await self.latestvolt_all
 
 
 @register
@@ -6,54 +6,57 @@ import attr
 
 
 class Event:
-    """Base class for all events"""
+    """Base class for all events.
 
-    pass
+    Events are slotted; they don't have a ``__dict__``.
+    """
+
+    __slots__ = ()
 
 
-@attr.s
+@attr.s(slots=True)
 class ServerEvent(Event):
     """Base class for all server-related events"""
 
     server = attr.ib()
 
 
-@attr.s
+@attr.s(slots=True)
 class ServerRegistered(ServerEvent):
     """A new known server appears. The server is not yet connected!"""
 
     pass
 
 
-@attr.s
+@attr.s(slots=True)
 class ServerConnected(ServerEvent):
     """We have connected to a server"""
 
     pass
 
 
-@attr.s
+@attr.s(slots=True)
 class ServerDisconnected(ServerEvent):
     """We have disconnected from a server"""
 
     pass
 
 
-@attr.s
+@attr.s(slots=True)
 class ServerDeregistered(ServerEvent):
     """This server is no longer known"""
 
     pass
 
 
-@attr.s
+@attr.s(slots=True)
 class BusEvent(Event):
     """Base class for all Bus-related events"""
 
     bus = attr.ib()
 
 
-@attr.s
+@attr.s(slots=True)
 class BusAdded(BusEvent):
     """The Bus has been created. Its location is not yet known!"""
 
@@ -79,35 +82,50 @@ class BusAdded_Path:
         return self.path == x
 
 
-@attr.s
+@attr.s(slots=True)
 class BusDeleted(BusEvent):
     """The Bus has been deleted"""
 
     pass
 
 
-@attr.s
+@attr.s(slots=True)
+class BusValues(BusEvent):
+    """A simultaneous conversion on this bus has been read.
+
+    ``values`` maps each device to its value. Readings suppressed by a
+    device's filter are not included. Only sent if the service's
+    ``aggregate_polls`` option is set; there are no separate
+    :class:`DeviceValue` events for these readings.
+    """
+
+    attribute = attr.ib()
+    values = attr.ib(factory=dict)
+    late = attr.ib(default=0, eq=False)
+
+
+@attr.s(slots=True)
 class DeviceEvent(Event):
     """Base class for all device-related events"""
 
     device = attr.ib()
 
 
-@attr.s
+@attr.s(slots=True)
 class DeviceAdded(DeviceEvent):
     """The device has been created. Its location is not yet known!"""
 
     pass
 
 
-@attr.s
+@attr.s(slots=True)
 class DeviceDeleted(DeviceEvent):
     """The device has been deleted"""
 
     pass
 
 
-@attr.s
+@attr.s(slots=True)
 class DeviceLocated(DeviceEvent):
     """The device has been found"""
 
@@ -126,14 +144,14 @@ class DeviceLocated(DeviceEvent):
         return self.device.bus
 
 
-@attr.s
+@attr.s(slots=True)
 class DeviceNotFound(DeviceEvent):
     """The device's location is no longer known"""
 
     pass
 
 
-@attr.s
+@attr.s(slots=True)
 class DeviceAlarm(DeviceEvent):
     """The device triggered an alarm condition."""
 
@@ -141,15 +159,19 @@ class DeviceAlarm(DeviceEvent):
     pass
 
 
-@attr.s
+@attr.s(slots=True)
 class DeviceValue(DeviceEvent):
-    """The device poll has read a value."""
+    """The device poll has read a value.
+
+    ``late`` is the time by which the poll missed its scheduled start.
+    """
 
     attribute = attr.ib()
     value = attr.ib()
+    late = attr.ib(default=0, eq=False)
 
 
-@attr.s
+@attr.s(slots=True)
 class DeviceException(DeviceEvent):
     """The device poll did not work."""
 
@@ -0,0 +1,163 @@
+"""
+Recent values of polled attributes.
+"""
+
+from array import array
+from bisect import bisect_left, bisect_right
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+from .event import BusValues, DeviceValue
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+__all__ = ["History", "RingBuffer"]
+
+
+class RingBuffer:
+    """The last ``size`` samples of one value.
+
+    Timestamps and values are stored as 64-bit floats in two preallocated
+    arrays, so a buffer takes 16 bytes per sample no matter how many
+    samples have been added. NumPy is used if it's installed, otherwise
+    :mod:`array`.
+
+    Times are the service's clock, i.e. ``await anyio.current_time()``.
+    Samples must be added in chronological order.
+
+    All queries return samples oldest first.
+    """
+
+    def __init__(self, size: int):
+        if size < 1:
+            raise ValueError(size)
+        self.size = size
+        if np is not None:
+            self._t = np.zeros(size)
+            self._v = np.zeros(size)
+        else:
+            self._t = array("d", bytes(8 * size))
+            self._v = array("d", bytes(8 * size))
+        self._n = 0  # number of samples ever added
+
+    def __repr__(self):
+        return "<%s %d/%d>" % (self.__class__.__name__, len(self), self.size)
+
+    def __len__(self):
+        return min(self._n, self.size)
+
+    def append(self, t: float, value: float):
+        """Add a sample, overwriting the oldest if the buffer is full."""
+        i = self._n % self.size
+        self._t[i] = t
+        self._v[i] = value
+        self._n += 1
+
+    def _ordered(self, arr):
+        """The valid part of ``arr``, oldest first"""
+        if self._n <= self.size:
+            return arr[: self._n]
+        i = self._n % self.size
+        if np is not None:
+            return np.concatenate((arr[i:], arr[:i]))
+        return arr[i:] + arr[:i]
+
+    def latest(self):
+        """Return the last sample as (time, value), or ``None``."""
+        if not self._n:
+            return None
+        i = (self._n - 1) % self.size
+        return self._t[i], self._v[i]
+
+    def last(self, n: int):
+        """Return the last ``n`` samples as (times, values)."""
+        n = min(n, len(self))
+        if n <= 0:
+            return self._t[:0], self._v[:0]
+        return self._ordered(self._t)[-n:], self._ordered(self._v)[-n:]
+
+    def range(self, start: float = None, end: float = None):
+        """Return the samples with ``start <= time <= end`` as
+        (times, values). ``None`` means unlimited."""
+        t = self._ordered(self._t)
+        v = self._ordered(self._v)
+        if np is not None:
+            a = 0 if start is None else int(np.searchsorted(t, start, "left"))
+            b = len(t) if end is None else int(np.searchsorted(t, end, "right"))
+        else:
+            a = 0 if start is None else bisect_left(t, start)
+            b = len(t) if end is None else bisect_right(t, end)
+        return t[a:b], v[a:b]
+
+    def stats(self, start: float = None, end: float = None):
+        """Return a dict with ``count``, ``min``, ``max`` and ``mean`` of
+        the samples in the given time range, or ``None`` if there are
+        none."""
+        _, v = self.range(start, end)
+        n = len(v)
+        if not n:
+            return None
+        if np is not None:
+            return dict(count=n, min=float(v.min()), max=float(v.max()), mean=float(v.mean()))
+        return dict(count=n, min=min(v), max=max(v), mean=sum(v) / n)
+
+
+class History:
+    """Keeps a :class:`RingBuffer` for each polled (device, attribute).
+
+    Enable it with the service's ``history`` argument. It records every
+    numeric :class:`asyncowfs.event.DeviceValue` (and the values in a
+    :class:`asyncowfs.event.BusValues` event). The elements of list values,
+    e.g. the four voltages of a DS2450, are stored separately as
+    ``voltage/0`` … ``voltage/3``. Other values are ignored.
+
+    Memory use is bounded by 16 bytes times ``size`` per attribute, plus
+    a fixed overhead of a few hundred bytes.
+    """
+
+    def __init__(self, size: int = 1000):
+        self.size = size
+        self._buffers = dict()  # (device ID, attribute) => RingBuffer
+
+    def __len__(self):
+        return len(self._buffers)
+
+    def _add(self, dev, attribute, t, value):
+        if isinstance(value, (list, tuple)):
+            for i, v in enumerate(value):
+                self._add(dev, "%s/%d" % (attribute, i), t, v)
+            return
+        if not isinstance(value, (int, float)):
+            return
+        if not isinstance(attribute, str):
+            attribute = "/".join(str(x) for x in attribute)
+        key = (dev.id, attribute)
+        try:
+            buf = self._buffers[key]
+        except KeyError:
+            self._buffers[key] = buf = RingBuffer(self.size)
+        buf.append(t, value)
+
+    def record(self, event, t: float):
+        """Store the values in this event, if any."""
+        if isinstance(event, DeviceValue):
+            self._add(event.device, event.attribute, t, event.value)
+        elif isinstance(event, BusValues):
+            for dev, value in event.values.items():
+                self._add(dev, event.attribute, t, value)
+
+    def get(self, device, attribute: str):
+        """Return the buffer for this device (or ID) and attribute, or
+        ``None`` if no value has been recorded."""
+        return self._buffers.get((getattr(device, "id", device), attribute))
+
+    def drop(self, device):
+        """Forget all values of this device."""
+        dev_id = getattr(device, "id", device)
+        for key in [k for k in self._buffers if k[0] == dev_id]:
+            del self._buffers[key]
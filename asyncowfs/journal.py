@@ -0,0 +1,453 @@
+"""
+Recording events to a file, and playing them back.
+"""
+
+import os
+import re
+import struct
+
+import anyio
+import attr
+
+from . import event as _event
+from .bus import Bus
+from .device import Device
+from .server import Server
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+__all__ = ["JournalWriter", "read_journal", "replay"]
+
+MAGIC = b"OWJ1"
+
+_len = struct.Struct("!I")
+_idx = struct.Struct("!I")
+_int = struct.Struct("!q")
+_float = struct.Struct("!d")
+_head = struct.Struct("!dIB")  # time, event class, number of fields
+
+MAX_INTERN = 65536
+
+
+class JournalError(RuntimeError):
+    """The journal file is damaged."""
+
+    pass
+
+
+class ReplayedError(Exception):
+    """Stands in for an exception recorded in a journal.
+
+    ``name`` is the original class name.
+    """
+
+    def __init__(self, name, msg):
+        super().__init__(msg)
+        self.name = name
+
+    def __repr__(self):
+        return "%s(%r)" % (self.name, str(self))
+
+
+class ReplayedBus:
+    """Stands in for a bus recorded in a journal."""
+
+    __slots__ = ("path",)
+
+    def __init__(self, path):
+        self.path = path
+
+    def __repr__(self):
+        return "<%s %s>" % (self.__class__.__name__, "/" + "/".join(self.path))
+
+    def __eq__(self, x):
+        return self.path == getattr(x, "path", x)
+
+    def __hash__(self):
+        return hash(self.path)
+
+
+class ReplayedServer:
+    """Stands in for a server recorded in a journal."""
+
+    __slots__ = ("name",)
+
+    def __init__(self, name):
+        self.name = name
+
+    def __repr__(self):
+        return "<%s %s>" % (self.__class__.__name__, self.name)
+
+
+class JournalWriter:
+    """Writes events to a series of journal files.
+
+    Each file starts with ``OWJ1``, followed by records which are prefixed
+    with their length as a 4-byte big-endian integer. A record is either
+    a definition, which assigns a number to a device ID or a string, or an
+    event: the service's monotonic timestamp as a double, the event's
+    class, and its fields. Values are tagged: ints and floats take 8 bytes,
+    device IDs and short strings 4, lists of floats 8 per element. Tuples
+    and lists are tagged differently, so tuples are replayed as tuples.
+
+    Files are named ``<base>.<n>``, with ``n`` counting up. A new file is
+    started when the current one exceeds ``max_size`` bytes; if ``keep``
+    is set, only that many files are retained. Each file can be read on
+    its own.
+
+    :meth:`write` only encodes the event. The file is written by
+    :meth:`flush` and :meth:`close`, which block; :meth:`record` calls
+    ``flush`` in a worker thread.
+
+    :param base: path and name prefix of the journal files.
+    :param max_size: rotation size in bytes.
+    :param keep: the number of files to keep. Default: all.
+    """
+
+    def __init__(self, base, max_size: int = 10 * 2 ** 20, keep: int = None):
+        self.base = base
+        self.max_size = max_size
+        self.keep = keep
+        self.records = 0
+        self._file = None
+        self._file_seq = None
+        self._seq = max((n for n, _ in _journal_files(base)), default=-1)
+        self._size = None  # of the current file, or None to start a new one
+        self._pending = []  # (file number, list of data) to be written
+        self._strings = dict()  # str => index
+        self._devices = dict()  # device ID => index
+
+    def __repr__(self):
+        return "<%s %s.%d>" % (self.__class__.__name__, self.base, self._seq)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *tb):
+        self.close()
+
+    def _open(self):
+        self._seq += 1
+        self._pending.append((self._seq, [MAGIC]))
+        self._size = len(MAGIC)
+        self._strings = dict()
+        self._devices = dict()
+
+    def _record(self, data):
+        if not self._pending:
+            self._pending.append((self._seq, []))
+        self._pending[-1][1].append(_len.pack(len(data)) + data)
+        self._size += _len.size + len(data)
+
+    def _intern(self, s, force=False):
+        try:
+            return self._strings[s]
+        except KeyError:
+            if len(self._strings) >= MAX_INTERN and not force:
+                return None
+            i = self._strings[s] = len(self._strings)
+            self._record(b"s" + _idx.pack(i) + s.encode("utf-8"))
+            return i
+
+    def _device(self, dev_id):
+        try:
+            return self._devices[dev_id]
+        except KeyError:
+            i = self._devices[dev_id] = len(self._devices)
+            self._record(b"d" + _idx.pack(i) + dev_id.encode("utf-8"))
+            return i
+
+    def _str(self, s, out):
+        i = self._intern(s) if len(s) <= 64 else None
+        if i is None:
+            b = s.encode("utf-8")
+            out.append(b"u" + _idx.pack(len(b)) + b)
+        else:
+            out.append(b"s" + _idx.pack(i))
+
+    def _value(self, v, out):
+        # bool is a subclass of int, so it goes first
+        if v is None:
+            out.append(b"N")
+        elif v is True:
+            out.append(b"T")
+        elif v is False:
+            out.append(b"F")
+        elif isinstance(v, float):
+            out.append(b"f" + _float.pack(v))
+        elif isinstance(v, int) and -(2 ** 63) <= v < 2 ** 63:
+            out.append(b"i" + _int.pack(v))
+        elif isinstance(v, str):
+            self._str(v, out)
+        elif isinstance(v, Device):
+            out.append(b"D" + _idx.pack(self._device(v.id)))
+        elif isinstance(v, (Bus, ReplayedBus)):
+            out.append(b"B")
+            self._str("/".join(v.path), out)
+        elif isinstance(v, (Server, ReplayedServer)):
+            out.append(b"S")
+            self._str(getattr(v, "name", None) or str(v), out)
+        elif isinstance(v, BaseException):
+            out.append(b"E")
+            self._str(getattr(v, "name", type(v).__name__), out)
+            self._str(str(v), out)
+        elif isinstance(v, tuple):
+            out.append(b"t" + _idx.pack(len(v)))
+            for x in v:
+                self._value(x, out)
+        elif isinstance(v, list):
+            if v and all(isinstance(x, float) for x in v):
+                out.append(b"a" + _idx.pack(len(v)) + struct.pack("!%dd" % len(v), *v))
+            else:
+                out.append(b"l" + _idx.pack(len(v)))
+                for x in v:
+                    self._value(x, out)
+        elif isinstance(v, dict):
+            out.append(b"m" + _idx.pack(len(v)))
+            for k, x in v.items():
+                self._value(k, out)
+                self._value(x, out)
+        else:
+            self._str(repr(v), out)
+
+    def write(self, event, t: float):
+        """Append this event, which happened at time ``t``."""
+        if self._size is None:
+            self._open()
+        fields = attr.fields(type(event))
+        # there are few event classes, so their names are always interned
+        cls = self._intern(type(event).__name__, force=True)
+        out = [_head.pack(t, cls, len(fields))]
+        for f in fields:
+            self._value(getattr(event, f.name), out)
+        self._record(b"e" + b"".join(out))
+        self.records += 1
+        if self._size >= self.max_size:
+            self._size = None
+
+    def flush(self):
+        """Write the pending events to disk."""
+        pending, self._pending = self._pending, []
+        for seq, data in pending:
+            if self._file_seq != seq:
+                self._close_file()
+                self._file = open("%s.%d" % (self.base, seq), "wb")
+                self._file_seq = seq
+                if self.keep:
+                    for n, path in _journal_files(self.base):
+                        if n <= seq - self.keep:
+                            os.unlink(path)
+            self._file.write(b"".join(data))
+        if self._file is not None:
+            if self._size is None:
+                self._close_file()  # full
+            else:
+                self._file.flush()
+
+    def _close_file(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+            self._file_seq = None
+
+    def close(self):
+        """Write the pending events, and close the file. The next event
+        starts a new one."""
+        self._size = None
+        self.flush()
+
+    async def record(self, service, evt=None, **kw):
+        """Write all events of this service, until it's closed or this is
+        cancelled.
+
+        Events are timestamped when they're sent. Each batch of events
+        is written to disk in a worker thread, so a slow disk doesn't
+        block the service; events that arrive meanwhile are queued in the
+        subscription.
+
+        :param evt: an event that's set when the subscription is active.
+        :param kw: passed to :meth:`asyncowfs.service.Service.subscribe`.
+            By default, all events are recorded, and the oldest ones are
+            dropped if writing falls behind, instead of stalling the
+            service.
+        """
+        kw.setdefault("types", _event.Event)
+        kw.setdefault("policy", "drop_oldest")
+        try:
+            async with service.subscribe(timestamps=True, **kw) as sub:
+                if evt is not None:
+                    await evt.set()
+                while True:
+                    try:
+                        events = await sub.receive_batch(1000)
+                    except anyio.EndOfStream:
+                        break
+                    for t, e in events:
+                        self.write(e, t)
+                    await anyio.run_sync_in_worker_thread(self.flush)
+        finally:
+            self.close()
+
+
+def _journal_files(base):
+    """Return (n, path) of the journal files for ``base``, in order."""
+    d, name = os.path.split(base)
+    pat = re.compile(re.escape(name) + r"\.(\d+)$")
+    res = []
+    try:
+        entries = os.listdir(d or ".")
+    except FileNotFoundError:
+        return res
+    for f in entries:
+        m = pat.match(f)
+        if m:
+            res.append((int(m.group(1)), os.path.join(d, f)))
+    res.sort()
+    return res
+
+
+class _DeviceRef(tuple):
+    """A ``("device", ID)`` tuple read from a journal"""
+
+    __slots__ = ()
+
+
+class _Reader:
+    def __init__(self, data):
+        self.data = data
+        self.pos = 0
+
+    def take(self, n):
+        p = self.pos
+        self.pos += n
+        if self.pos > len(self.data):
+            raise JournalError("Record too short")
+        return self.data[p : self.pos]
+
+    def unpack(self, s):
+        return s.unpack(self.take(s.size))
+
+
+def _read_value(r, strings, devices):
+    tag = r.take(1)
+    if tag == b"N":
+        return None
+    if tag == b"T":
+        return True
+    if tag == b"F":
+        return False
+    if tag == b"f":
+        return r.unpack(_float)[0]
+    if tag == b"i":
+        return r.unpack(_int)[0]
+    if tag == b"s":
+        return strings[r.unpack(_idx)[0]]
+    if tag == b"u":
+        return r.take(r.unpack(_idx)[0]).decode("utf-8")
+    if tag == b"D":
+        return _DeviceRef(("device", devices[r.unpack(_idx)[0]]))
+    if tag == b"B":
+        path = _read_value(r, strings, devices)
+        return ReplayedBus(tuple(path.split("/")) if path else ())
+    if tag == b"S":
+        return ReplayedServer(_read_value(r, strings, devices))
+    if tag == b"E":
+        name = _read_value(r, strings, devices)
+        return ReplayedError(name, _read_value(r, strings, devices))
+    if tag == b"a":
+        n = r.unpack(_idx)[0]
+        return list(struct.unpack("!%dd" % n, r.take(8 * n)))
+    if tag == b"l":
+        return [_read_value(r, strings, devices) for _ in range(r.unpack(_idx)[0])]
+    if tag == b"t":
+        return tuple(_read_value(r, strings, devices) for _ in range(r.unpack(_idx)[0]))
+    if tag == b"m":
+        res = dict()
+        for _ in range(r.unpack(_idx)[0]):
+            k = _read_value(r, strings, devices)
+            res[k] = _read_value(r, strings, devices)
+        return res
+    raise JournalError("Unknown tag %r" % (tag,))
+
+
+def read_journal(path):
+    """Read one journal file.
+
+    This is a generator of (time, event class name, field values). Devices
+    are returned as ``("device", ID)`` tuples.
+    """
+    strings = dict()
+    devices = dict()
+    with open(path, "rb") as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise JournalError("%s: not a journal" % (path,))
+        while True:
+            hdr = f.read(_len.size)
+            if not hdr:
+                return
+            if len(hdr) < _len.size:
+                logger.warning("%s: truncated", path)
+                return
+            n = _len.unpack(hdr)[0]
+            data = f.read(n)
+            if len(data) < n:
+                logger.warning("%s: truncated", path)
+                return
+            r = _Reader(data)
+            typ = r.take(1)
+            if typ in (b"s", b"d"):
+                i = r.unpack(_idx)[0]
+                (strings if typ == b"s" else devices)[i] = r.data[r.pos :].decode("utf-8")
+            elif typ == b"e":
+                t, cls, nf = r.unpack(_head)
+                fields = [_read_value(r, strings, devices) for _ in range(nf)]
+                yield t, strings[cls], fields
+            else:
+                raise JournalError("%s: unknown record %r" % (path, typ))
+
+
+async def _resolve(service, v):
+    if isinstance(v, _DeviceRef):
+        return await service.get_device(v[1])
+    if isinstance(v, list):
+        return [await _resolve(service, x) for x in v]
+    if isinstance(v, tuple):
+        return tuple([await _resolve(service, x) for x in v])
+    if isinstance(v, dict):
+        return {await _resolve(service, k): await _resolve(service, x) for k, x in v.items()}
+    return v
+
+
+async def replay(service, base, speed: float = 1):
+    """Feed the events in the journal files for ``base`` to the service's
+    subscribers.
+
+    Devices are looked up (or created) with ``service.get_device``. Buses,
+    servers and exceptions are represented by :class:`ReplayedBus`,
+    :class:`ReplayedServer` and :class:`ReplayedError`.
+
+    :param speed: 1 replays in real time, 10 ten times as fast. ``None``
+        or zero sends the events as fast as possible.
+    :return: the number of events sent.
+    """
+    n = 0
+    t0 = None
+    start = await anyio.current_time()
+    for _, path in _journal_files(base):
+        for t, name, fields in read_journal(path):
+            cls = getattr(_event, name, None)
+            if cls is None or not isinstance(cls, type) or not issubclass(cls, _event.Event):
+                logger.warning("Unknown event type %r", name)
+                continue
+            if t0 is None:
+                t0 = t
+            if speed:
+                delay = start + (t - t0) / speed - await anyio.current_time()
+                if delay > 0:
+                    await anyio.sleep(delay)
+            fields = [await _resolve(service, f) for f in fields]
+            await service.push_event(cls(*fields))
+            n += 1
+    return n
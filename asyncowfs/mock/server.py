@@ -2,7 +2,7 @@ import os
 import trio
 import anyio
 from asyncowfs import OWFS
-from asyncowfs.protocol import MessageProtocol, OWMsg
+from asyncowfs.protocol import MessageProtocol, OWMsg, OWFlag
 from asyncowfs.error import OWFSReplyError, NoEntryError, IsDirError
 
 try:
@@ -70,6 +70,9 @@ async def some_server(tree, options, socket):
     See the ``tests/test_example.pytest_basic_structs`` test for example
     use.
 
+    If ``options`` contains a ``dir_log`` list, each directory request
+    appends a ``(path, uncached)`` tuple to it.
+
     ``socket``: the connection to the client.
     """
     rdr = MessageProtocol(FakeMaster(socket), is_server=True)
@@ -78,6 +81,7 @@ async def some_server(tree, options, socket):
     each_busy = options.get("busy_every", None)
     each_close = options.get("close_every", None)
     each_slow = options.get("slow_every", None)
+    dir_log = options.get("dir_log", None)
     try:
         if _chk(each_close):
             return
@@ -93,6 +97,9 @@ async def some_server(tree, options, socket):
                     await rdr.write(0, format_flags, 0)
                 elif command == OWMsg.dirall:
                     data = data.rstrip(b"\0")
+                    if dir_log is not None:
+                        uncached = bool(format_flags & OWFlag.uncached)
+                        dir_log.append((data.decode("utf-8"), uncached))
                     subtree = tree
                     path = []
                     for k in data.split(b"/"):
@@ -27,6 +27,27 @@ structs = {
         },
     },
     "1F": {},
-    "20": {},
-    "28": {},
+    "20": {
+        "address": "a,000000,000001,ro,000016,f,",
+        "family": "a,000000,000001,ro,000002,f,",
+        "id": "a,000000,000001,ro,000012,f,",
+        "latestvolt.A": "g,000000,000004,ro,000008,v,",
+        "volt.A": "g,000000,000004,ro,000008,v,",
+        "power": "y,000000,000001,rw,000001,s,",
+        "set_alarm": {"volthigh.A": "g,000000,000004,rw,000008,s,"},
+    },
+    "28": {
+        "address": "a,000000,000001,ro,000016,f,",
+        "family": "a,000000,000001,ro,000002,f,",
+        "id": "a,000000,000001,ro,000012,f,",
+        "latesttemp": "t,000000,000001,ro,000012,v,",
+        "power": "y,000000,000001,ro,000001,v,",
+        "temperature": "t,000000,000001,ro,000012,v,",
+        "temperature9": "t,000000,000001,ro,000012,v,",
+        "temperature10": "t,000000,000001,ro,000012,v,",
+        "temperature11": "t,000000,000001,ro,000012,v,",
+        "temperature12": "t,000000,000001,ro,000012,v,",
+        "temphigh": "t,000000,000001,rw,000012,s,",
+        "templow": "t,000000,000001,rw,000012,s,",
+    },
 }
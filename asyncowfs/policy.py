@@ -0,0 +1,249 @@
+"""
+Per-attribute polling and writing policies.
+"""
+
+import anyio
+
+from .util import ValueEvent
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+__all__ = ["ValueFilter", "AdaptiveInterval", "WriteCoalescer"]
+
+_NOTHING = object()
+
+
+class ValueFilter:
+    """Decides whether a polled value is worth reporting.
+
+    A value is reported if
+
+    * it's the first one, or the first after an error,
+    * it differs from the last reported value by more than ``deadband``,
+      or by more than ``rel_deadband`` times that value,
+    * no deadband is set, ``on_change`` is set, and it differs from the
+      last reported value at all,
+    * nothing has been reported for ``heartbeat`` seconds.
+
+    Values are compared to the last one that was *reported*, so a slow
+    drift is reported eventually. Lists (e.g. all four voltages of a
+    DS2450) are reported if any element exceeds the deadband. Values that
+    can't be subtracted (e.g. strings) are reported when they change.
+
+    :param deadband: absolute change that must be exceeded.
+    :param rel_deadband: relative change that must be exceeded.
+    :param on_change: report changed values only.
+    :param heartbeat: maximum time without a report.
+    """
+
+    def __init__(self, deadband=None, rel_deadband=None, on_change=False, heartbeat=None):
+        self.deadband = deadband
+        self.rel_deadband = rel_deadband
+        self.on_change = on_change
+        self.heartbeat = heartbeat
+        self.last = _NOTHING
+        self.last_time = None
+
+    def __repr__(self):
+        return "<%s %s>" % (
+            self.__class__.__name__,
+            " ".join(
+                "%s=%s" % (k, v)
+                for k, v in (
+                    ("deadband", self.deadband),
+                    ("rel_deadband", self.rel_deadband),
+                    ("on_change", self.on_change),
+                    ("heartbeat", self.heartbeat),
+                )
+                if v
+            ),
+        )
+
+    @property
+    def active(self):
+        """Whether this filter may suppress anything."""
+        return bool(self.on_change or self.deadband or self.rel_deadband)
+
+    def reset(self):
+        """Report the next value unconditionally."""
+        self.last = _NOTHING
+
+    def _exceeds(self, value, last):
+        try:
+            diff = abs(value - last)
+            limit = max(self.deadband or 0, (self.rel_deadband or 0) * abs(last))
+        except TypeError:
+            return value != last
+        return diff > limit
+
+    def _changed(self, value):
+        last = self.last
+        if not (self.deadband or self.rel_deadband):
+            return value != last
+        if isinstance(value, (list, tuple)) and isinstance(last, (list, tuple)):
+            if len(value) != len(last):
+                return True
+            return any(self._exceeds(v, l) for v, l in zip(value, last))
+        return self._exceeds(value, last)
+
+    def check(self, value, now):
+        """Return ``True`` if ``value``, read at time ``now``, should be
+        reported. If so, it becomes the new reference value."""
+        if not self.active:
+            return True
+        if (
+            self.last is _NOTHING
+            or (self.heartbeat is not None and now - self.last_time >= self.heartbeat)
+            or self._changed(value)
+        ):
+            self.last = value
+            self.last_time = now
+            return True
+        return False
+
+
+class AdaptiveInterval:
+    """Adapts a polling interval to how fast the polled value changes.
+
+    If consecutive samples differ by more than ``step``, the interval is
+    halved; if they differ by less than a quarter of ``step``, it's
+    increased by a quarter. It always stays between ``min_interval`` and
+    ``max_interval``.
+
+    Lists are compared element-wise; values that can't be subtracted count
+    as fast-changing when they're different.
+
+    :param interval: the initial interval.
+    :param step: the change that should be resolved. Default: zero, i.e.
+        any change tightens the interval.
+    """
+
+    def __init__(self, interval, min_interval, max_interval, step=0):
+        if min_interval <= 0 or min_interval > max_interval:
+            raise ValueError("Interval bounds: %r %r" % (min_interval, max_interval))
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.step = step
+        self.interval = min(max(interval, min_interval), max_interval)
+        self.last = _NOTHING
+
+    def __repr__(self):
+        return "<%s %s [%s:%s]>" % (
+            self.__class__.__name__,
+            self.interval,
+            self.min_interval,
+            self.max_interval,
+        )
+
+    @staticmethod
+    def _delta(value, last):
+        if isinstance(value, (list, tuple)) and isinstance(last, (list, tuple)):
+            if len(value) != len(last):
+                return None
+            d = 0
+            for v, l in zip(value, last):
+                dd = AdaptiveInterval._delta(v, l)
+                if dd is None:
+                    return None
+                d = max(d, dd)
+            return d
+        try:
+            return abs(value - last)
+        except TypeError:
+            return 0 if value == last else None
+
+    def update(self, value):
+        """Record a new sample.
+
+        :return: the new interval if it changed, else ``None``.
+        """
+        last, self.last = self.last, value
+        if last is _NOTHING:
+            return None
+        d = self._delta(value, last)
+        i = self.interval
+        if d is None or d > self.step:
+            i = max(i / 2, self.min_interval)
+        elif d <= self.step / 4:
+            i = min(i * 1.25, self.max_interval)
+        if i == self.interval:
+            return None
+        self.interval = i
+        return i
+
+
+class WriteCoalescer:
+    """Last-write-wins writing of one attribute.
+
+    At most one write is in flight. Values written meanwhile replace each
+    other; only the latest one is sent when the current write is done.
+    Every caller waits for the write that carries its value or replaced
+    it, and gets that write's result.
+
+    Writes run in a task started with ``spawn``, so a caller that's
+    cancelled doesn't affect the others.
+
+    :param write: the async function to call with each value.
+    :param spawn: starts the writer task, e.g. a nursery's ``spawn``.
+    :param spacing: the minimum time between the start of two writes.
+        Values written during that time are coalesced too.
+    """
+
+    def __init__(self, write, spawn, spacing: float = 0):
+        self._write = write
+        self._spawn = spawn
+        self.spacing = spacing
+        self.writes = 0  # number of values actually written
+        self.coalesced = 0  # number of values replaced by a later one
+        self._value = None
+        self._pending = None  # ValueEvent for the next write
+        self._running = False
+        self._last = None  # start of the last write
+
+    def __repr__(self):
+        return "<%s %d/%d spacing=%s>" % (
+            self.__class__.__name__,
+            self.writes,
+            self.writes + self.coalesced,
+            self.spacing,
+        )
+
+    async def write(self, value):
+        """Write this value, or a later one."""
+        self._value = value
+        if self._pending is None:
+            self._pending = ValueEvent()
+        else:
+            self.coalesced += 1
+        evt = self._pending
+        if not self._running:
+            self._running = True
+            await self._spawn(self._run)
+        return await evt.get()
+
+    async def _run(self):
+        evt = None
+        try:
+            while self._pending is not None:
+                if self._last is not None and self.spacing:
+                    delay = self._last + self.spacing - await anyio.current_time()
+                    if delay > 0:
+                        await anyio.sleep(delay)
+                evt, self._pending = self._pending, None
+                value, self._value = self._value, None
+                self._last = await anyio.current_time()
+                self.writes += 1
+                try:
+                    res = await self._write(value)
+                except Exception as exc:  # pylint: disable=broad-except
+                    await evt.set_error(exc)
+                else:
+                    await evt.set(res)
+        finally:
+            self._running = False
+            for e in (evt, self._pending):
+                if e is not None and not e.is_set():
+                    await e.cancel()
+            self._pending = None
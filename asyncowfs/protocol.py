@@ -4,6 +4,7 @@
 
 import struct
 import anyio
+from collections import deque
 
 from .util import ValueEvent
 from .error import _errors, GenericOWFSReplyError
@@ -179,12 +180,95 @@ class MessageProtocol:
             )
 
 
+class MessageQueue:
+    """The requests waiting to be sent to an owserver.
+
+    Requests are grouped by the DS2409 coupler branch they address (see
+    :attr:`Message.branch`), so that owserver doesn't need to switch
+    couplers back and forth. Requests for the same branch are sent in the
+    order they were queued.
+
+    To keep a busy branch from starving the others, at most ``max_burst``
+    requests for one branch are sent in a row while other branches are
+    waiting. Branches take turns in the order they got a request queued.
+
+    :param max_len: the number of requests that may be queued. If the
+        queue is full, :meth:`send` blocks.
+    :param max_burst: the fairness limit.
+
+    ``switches`` counts how often consecutive requests that go through a
+    coupler addressed a different branch.
+    """
+
+    def __init__(self, max_len: int = 100, max_burst: int = 10):
+        self.max_len = max_len
+        self.max_burst = max_burst
+        self.switches = 0
+
+        self._queues = dict()  # branch => deque of messages
+        self._len = 0
+        self._current = None  # branch we're sending from
+        self._burst = 0  # number of messages sent from it
+        self._last = ()  # coupler branch of the last message sent
+        self._readable = anyio.create_event()
+        self._writable = anyio.create_event()
+
+    def __len__(self):
+        return self._len
+
+    async def send(self, msg):
+        """Queue a message. Waits if the queue is full."""
+        while self._len >= self.max_len:
+            await self._writable.wait()
+        try:
+            q = self._queues[msg.branch]
+        except KeyError:
+            self._queues[msg.branch] = q = deque()
+        q.append(msg)
+        self._len += 1
+
+        evt, self._readable = self._readable, anyio.create_event()
+        await evt.set()
+
+    async def receive(self):
+        """Return the next message to be sent. Waits if the queue is empty."""
+        while not self._len:
+            await self._readable.wait()
+
+        b = self._current
+        q = self._queues.get(b)
+        if q is None or (self._burst >= self.max_burst and len(self._queues) > 1):
+            if q is not None:
+                # move to the end of the line
+                del self._queues[b]
+                self._queues[b] = q
+            b = next(iter(self._queues))
+            q = self._queues[b]
+            self._current = b
+            self._burst = 0
+
+        msg = q.popleft()
+        if not q:
+            del self._queues[b]
+        self._len -= 1
+        self._burst += 1
+        if b and b != self._last:
+            if self._last:
+                self.switches += 1
+            self._last = b
+
+        evt, self._writable = self._writable, anyio.create_event()
+        await evt.set()
+        return msg
+
+
 _id = 0
 
 
 class Message:
+    __slots__ = ("typ", "data", "rlen", "event", "_id", "cancelled", "cached", "job", "sent")
+
     timeout = 0.5
-    cancelled = False
 
     def __init__(self, typ, data, rlen):
         # self.persist = persist
@@ -192,6 +276,10 @@ class Message:
         self.data = data
         self.rlen = rlen
         self.event = ValueEvent()
+        self.cancelled = False
+        self.cached = False  # if set, owserver may answer from its cache
+        self.job = None  # the poll job that's charged for this request
+        self.sent = None  # when this request was sent
         global _id
         _id += 1
         self._id = _id
@@ -209,7 +297,8 @@ class Message:
         flags = 0
         flags |= OWFlag.persist
         flags |= OWFlag.busret
-        flags |= OWFlag.uncached
+        if not self.cached:
+            flags |= OWFlag.uncached
         flags |= OWFlag.ownet
         flags |= OWtempformat.celsius << OWtempformat._offset
         flags |= OWdevformat.fdidc << OWdevformat._offset
@@ -239,6 +328,20 @@ class Message:
     def _process(self, data):
         return data
 
+    @property
+    def branch(self):
+        """The DS2409 coupler branch this message addresses.
+
+        This is the prefix of the message's path up to the last
+        ``main`` or ``aux`` component that follows a coupler's ID, or an
+        empty tuple if the path doesn't go through a coupler.
+        """
+        path = getattr(self, "path", ())
+        for i in range(len(path) - 1, 0, -1):
+            if path[i] in {"main", "aux"} and str(path[i - 1]).upper().startswith("1F."):
+                return path[: i + 1]
+        return ()
+
     @property
     def get_reply(self):
         return self.event.get
@@ -261,6 +364,8 @@ def _path(path):
 
 
 class NOPMsg(Message):
+    __slots__ = ()
+
     def __init__(self):
         super().__init__(OWMsg.nop, b"", 0)
 
@@ -271,6 +376,8 @@ class NOPMsg(Message):
 class AttrGetMsg(Message):
     """read an OWFS value"""
 
+    __slots__ = ("path",)
+
     timeout = 2
 
     def __init__(self, *path):
@@ -289,6 +396,8 @@ class AttrGetMsg(Message):
 class AttrSetMsg(Message):
     """write an OWFS value"""
 
+    __slots__ = ("path", "value")
+
     timeout = 1
 
     def __init__(self, *path, value):
@@ -311,14 +420,21 @@ class AttrSetMsg(Message):
 
 
 class DirMsg(Message):
-    """Read an owfs directory"""
+    """Read an owfs directory.
+
+    If ``cached`` is set, owserver may return its cached directory instead
+    of running a 1wire search.
+    """
+
+    __slots__ = ("path",)
 
     timeout = 10
 
-    def __init__(self, path):
+    def __init__(self, path, cached=False):
         self.path = path
         p = _path(self.path)
         super().__init__(OWMsg.dirall, p, len(p) - 1)
+        self.cached = cached
 
     def _process(self, data):
         if data == b"":
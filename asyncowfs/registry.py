@@ -0,0 +1,109 @@
+"""
+Device indexes.
+"""
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+__all__ = ["Registry"]
+
+
+def _branches(path):
+    """Enumerate the coupler branches a bus path is behind.
+
+    A path like ``bus.0/1F.123456.78/main/1F.9ABCDE.F0/aux`` yields
+    ``("1F.123456.78", "main")``, ``("1F.123456.78", None)``,
+    ``("1F.9ABCDE.F0", "aux")`` and ``("1F.9ABCDE.F0", None)``.
+    """
+    for i in range(1, len(path) - 1):
+        if path[i + 1] in {"main", "aux"}:
+            c = path[i].upper()
+            yield (c, path[i + 1])
+            yield (c, None)
+
+
+class Registry:
+    """Maintains lookup tables for devices.
+
+    The family index covers every device the service knows about. The
+    server and coupler indexes only contain devices with a known location;
+    they are updated by :meth:`asyncowfs.bus.Bus.add_device` and
+    :meth:`asyncowfs.device.Device.delocate`.
+
+    All lookups return snapshots, so it's safe to await (and thus let
+    a scan change the registry) while iterating over one.
+    """
+
+    def __init__(self):
+        self._family = dict()  # family => id => device
+        self._server = dict()  # server => id => device
+        self._server_family = dict()  # (server, family) => id => device
+        self._branch = dict()  # (coupler ID, "main"/"aux"/None) => id => device
+        self._keys = dict()  # id => list of (index, key) the device is in
+
+    @staticmethod
+    def _add(index, key, dev):
+        try:
+            d = index[key]
+        except KeyError:
+            index[key] = d = dict()
+        d[dev.id] = dev
+
+    @staticmethod
+    def _remove(index, key, dev):
+        d = index[key]
+        d.pop(dev.id, None)
+        if not d:
+            del index[key]
+
+    def add_device(self, dev):
+        """A new device is known."""
+        self._add(self._family, dev.family, dev)
+
+    def del_device(self, dev):
+        """The device has been deleted."""
+        self.delocate(dev)
+        self._remove(self._family, dev.family, dev)
+
+    def locate(self, dev, bus):
+        """The device has been found on this bus."""
+        self.delocate(dev)
+        server = bus.server
+        keys = [
+            (self._server, server),
+            (self._server_family, (server, dev.family)),
+        ]
+        keys.extend((self._branch, b) for b in _branches(bus.path))
+        for index, key in keys:
+            self._add(index, key, dev)
+        self._keys[dev.id] = keys
+
+    def delocate(self, dev):
+        """The device's location is no longer known."""
+        for index, key in self._keys.pop(dev.id, ()):
+            self._remove(index, key, dev)
+
+    def by_family(self, family, server=None):
+        """Return the devices of this family, optionally restricted to
+        those located on a specific server."""
+        if server is None:
+            d = self._family.get(family)
+        else:
+            d = self._server_family.get((server, family))
+        return tuple(d.values()) if d is not None else ()
+
+    def by_server(self, server):
+        """Return the devices located on this server."""
+        d = self._server.get(server)
+        return tuple(d.values()) if d is not None else ()
+
+    def behind(self, coupler, branch=None):
+        """Return the devices behind this coupler.
+
+        :param coupler: the coupler, or its ID
+        :param branch: "main" or "aux". Default: both.
+        """
+        coupler = getattr(coupler, "id", coupler).upper()
+        d = self._branch.get((coupler, branch))
+        return tuple(d.values()) if d is not None else ()
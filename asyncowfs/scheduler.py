@@ -0,0 +1,278 @@
+"""
+Central scheduling of periodic polls.
+"""
+
+import anyio
+import heapq
+from contextvars import ContextVar
+from math import ceil, inf
+from random import random as _random
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+__all__ = ["PollScheduler", "PollJob", "current_job"]
+
+# A failing poll's interval is doubled after each consecutive error, up to
+# this factor
+MAX_BACKOFF = 32
+
+_current_job = ContextVar("current_job", default=None)
+
+
+def current_job():
+    """Return the :class:`PollJob` that's running in this task, if any."""
+    return _current_job.get()
+
+
+class PollJob:
+    """One periodic poll, as returned by :meth:`PollScheduler.add`.
+
+    You may change ``interval``, ``stretch`` and ``random`` while the job
+    is active; the new values apply when the job is next rescheduled.
+    The job actually runs every ``period`` = ``interval * stretch``
+    seconds.
+
+    ``late`` is the delay between the deadline and the start of the last
+    poll; ``skipped`` counts deadlines that were missed entirely.
+    ``cost`` is a moving average of how long the poll takes, or ``None``
+    if it hasn't run yet. ``bus_cost`` is the same for the time owserver
+    spent on the poll's requests, i.e. without waiting for conversions or
+    for other requests. ``errors`` counts consecutive failures; ``slow``
+    is set while the job runs in the scheduler's slow lane.
+    """
+
+    deadline = None
+    running = False
+    cancelled = False
+    late = 0
+    skipped = 0
+    cost = None
+    bus_cost = None
+    bus_time = 0  # owserver time used by the current run
+    errors = 0
+    slow = False
+    stretch = 1
+    _seq = None
+
+    def __init__(self, scheduler, proc, interval, random=0, isolate=True, bus=None):
+        self.scheduler = scheduler
+        self.proc = proc
+        self.interval = interval
+        self.random = random
+        self.isolate = isolate
+        self.bus = bus
+
+    def __repr__(self):
+        return "<%s %s @%s>" % (self.__class__.__name__, self.proc, self.interval)
+
+    @property
+    def period(self):
+        """The interval, stretched to fit the bus's budget"""
+        return self.interval * self.stretch
+
+    def next_interval(self):
+        """The time until the next poll"""
+        i = self.period
+        if self.random:
+            i *= 1 + (_random() - 0.5) / self.random
+        return i
+
+    async def cancel(self):
+        """Stop polling.
+
+        A poll that's currently running is not interrupted.
+        """
+        if not self.cancelled:
+            self.cancelled = True
+            self.scheduler._n_jobs -= 1
+
+
+class PollScheduler:
+    """Runs all periodic polls of a service from a small pool of workers.
+
+    Pending jobs are kept in a heap, ordered by deadline, so adding a job
+    costs O(log n). Cancelled jobs and superseded deadlines are removed
+    lazily when they come up, or when they outnumber the active jobs.
+    A job is never run by more than one worker at a time.
+
+    Deadlines are absolute: a job's next deadline is its previous one plus
+    the interval, no matter how long the poll took, so polls don't drift.
+    If a poll overruns one or more following deadlines, these are skipped
+    instead of being run back-to-back.
+
+    Jobs are called with a ``late`` keyword argument: the time between the
+    deadline and the poll's actual start. A job fails if it raises an
+    exception or returns ``False``. The interval of a failing job is
+    doubled after each consecutive failure, up to :data:`MAX_BACKOFF`
+    times; the first success restores it.
+
+    :param workers: the number of polls that may run concurrently.
+    :param slow: if set, jobs that take longer than this many seconds
+        are moved to a separate lane with a single worker, so they can't
+        tie up the other workers. They move back when their cost drops
+        below half that value.
+    """
+
+    def __init__(self, service, workers: int = 10, slow: float = None):
+        self.service = service
+        self.workers = workers
+        self.slow = slow
+        self._heap = []  # (deadline, seq, job)
+        self._seq = 0
+        self._n_jobs = 0
+        self._changed = anyio.create_event()
+        self._q_w = self._q_r = None
+        self._slow_w = self._slow_r = None
+        self._started = False
+
+    def __len__(self):
+        """The number of active jobs"""
+        return self._n_jobs
+
+    async def add(self, proc, interval, first=None, random=0, isolate=True, bus=None):
+        """Schedule ``proc`` to be called every ``interval`` seconds.
+
+        :param first: delay until the first call. Default: ``interval``.
+        :param random: vary the interval by up to ±1/(2*random).
+        :param isolate: whether the job may be moved to the slow lane.
+        :param bus: the bus the job polls. Its ``job_done`` method is called
+            after each run.
+        :return: a :class:`PollJob`. Call its ``cancel`` method to stop.
+        """
+        if not self._started:
+            self._started = True
+            await self.service.add_task(self._run)
+        job = PollJob(self, proc, interval, random=random, isolate=isolate, bus=bus)
+        self._n_jobs += 1
+        if first is None:
+            first = job.next_interval()
+        await self._push(job, await anyio.current_time() + first)
+        return job
+
+    async def align(self, job, start):
+        """Move the job's deadlines so that they're at ``start`` plus some
+        multiple of its interval.
+
+        This is used to spread polls evenly. The next deadline moves by at
+        most half an interval, unless that would put it in the past.
+        """
+        if job.cancelled or job.period <= 0:
+            return
+        now = await anyio.current_time()
+        ref = now if job.deadline is None else job.deadline
+        if job.running:
+            ref += job.period
+        deadline = start + round((ref - start) / job.period) * job.period
+        if deadline < now:
+            deadline += ceil((now - deadline) / job.period) * job.period
+        if job.running:
+            # rescheduling adds the interval
+            job.deadline = deadline - job.period
+        elif deadline != job.deadline:
+            await self._push(job, deadline)
+
+    async def _push(self, job, deadline):
+        job.deadline = deadline
+        self._seq += 1
+        job._seq = self._seq
+        heapq.heappush(self._heap, (deadline, self._seq, job))
+        if len(self._heap) > 2 * self._n_jobs + 100:
+            # too many superseded entries: drop them
+            self._heap = [e for e in self._heap if not e[2].cancelled and e[2]._seq == e[1]]
+            heapq.heapify(self._heap)
+        if self._heap[0][2] is job:
+            evt, self._changed = self._changed, anyio.create_event()
+            await evt.set()
+
+    async def _run(self):
+        self._q_w, self._q_r = anyio.create_memory_object_stream(0)
+        self._slow_w, self._slow_r = anyio.create_memory_object_stream(inf)
+        try:
+            async with anyio.create_task_group() as tg:
+                for _ in range(self.workers):
+                    await tg.spawn(self._worker, self._q_r)
+                await tg.spawn(self._worker, self._slow_r)
+                await self._dispatch()
+        finally:
+            self._started = False
+
+    async def _dispatch(self):
+        while True:
+            if not self._heap:
+                await self._changed.wait()
+                continue
+            deadline, seq, job = self._heap[0]
+            if job.cancelled or job._seq != seq:
+                # cancelled, or superseded by a later entry
+                heapq.heappop(self._heap)
+                continue
+            delay = deadline - await anyio.current_time()
+            if delay > 0:
+                changed = self._changed
+                async with anyio.move_on_after(delay):
+                    await changed.wait()
+                continue
+            heapq.heappop(self._heap)
+            job.running = True
+            if job.slow:
+                await self._slow_w.send(job)
+            else:
+                await self._q_w.send(job)
+
+    async def _worker(self, lane):
+        while True:
+            job = await lane.receive()
+            await self._run_job(job)
+
+    async def _run_job(self, job):
+        t = await anyio.current_time()
+        job.late = max(0, t - job.deadline)
+        job.bus_time = 0
+        ok = False
+        token = _current_job.set(job)
+        try:
+            ok = await job.proc(late=job.late) is not False
+        except Exception:  # pylint: disable=broad-except
+            logger.exception("Poll %r", job)
+        finally:
+            _current_job.reset(token)
+            job.running = False
+        now = await anyio.current_time()
+        t = now - t
+        job.cost = t if job.cost is None else (job.cost * 3 + t) / 4
+        t = job.bus_time
+        job.bus_cost = t if job.bus_cost is None else (job.bus_cost * 3 + t) / 4
+        if job.bus is not None:
+            job.bus.job_done(job, now)
+
+        if ok:
+            job.errors = 0
+        else:
+            job.errors += 1
+        if self.slow is not None and job.isolate:
+            if job.cost > self.slow:
+                if not job.slow:
+                    logger.info("Slow poll %r", job)
+                job.slow = True
+            elif job.cost < self.slow / 2:
+                job.slow = False
+
+        if not job.cancelled:
+            await self._reschedule(job)
+
+    async def _reschedule(self, job):
+        now = await anyio.current_time()
+        i = job.next_interval()
+        if job.errors:
+            i *= min(2 ** job.errors, MAX_BACKOFF)
+        deadline = job.deadline + i
+        if deadline <= now:
+            if job.period > 0:
+                skip = ceil((now - deadline) / job.period)
+            else:
+                skip = 0
+            deadline = max(deadline + skip * job.period, now)
+            job.skipped += skip
+        await self._push(job, deadline)
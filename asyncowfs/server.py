@@ -3,9 +3,11 @@ Access to an owserver.
 """
 
 import anyio
+import attr
 
+from random import random as _random
 from collections import deque
-from typing import Union
+from typing import Optional, Union
 from functools import partial
 from concurrent.futures import CancelledError
 
@@ -17,9 +19,11 @@ from .protocol import (
     AttrGetMsg,
     AttrSetMsg,
     MessageProtocol,
+    MessageQueue,
     ServerBusy,
 )
 from .bus import Bus
+from .scheduler import current_job
 from .util import ValueEvent
 
 import logging
@@ -27,12 +31,80 @@ import logging
 logger = logging.getLogger(__name__)
 
 
+@attr.s(eq=False)
+class WriteBufferFull(RuntimeError):
+    """The server is offline and its write buffer is full."""
+
+    server = attr.ib()
+    path = attr.ib()
+
+
+class _OfflineWrite:
+    """A write that waits for the server to come back."""
+
+    __slots__ = ("path", "value", "priority", "seq", "event", "waiters", "on_error")
+
+    def __init__(self, path, value, priority, seq):
+        self.path = path
+        self.value = value
+        self.priority = priority
+        self.seq = seq
+        self.event = ValueEvent()
+        self.waiters = 0
+        self.on_error = []
+
+    async def get_reply(self):
+        """Wait until this write has been sent, and return the result."""
+        self.waiters += 1
+        try:
+            return await self.event.get()
+        finally:
+            self.waiters -= 1
+
+    async def cancel(self):
+        """Stop waiting. The write stays buffered."""
+        pass
+
+    async def done(self, exc=None):
+        if exc is None:
+            await self.event.set(None)
+            return
+        if not self.waiters and not self.on_error:
+            logger.error("Write to %s failed: %r", "/".join(self.path), exc)
+        await self.event.set_error(exc)
+        for cb in self.on_error:
+            try:
+                cb(exc)
+            except Exception:  # pylint: disable=broad-except
+                logger.exception("Error callback for %s", self.path)
+
+
 class Server:
     """\
         Encapsulate one server connection.
+
+        :param max_inflight: the number of requests that may be sent to
+            owserver before receiving a reply. Requests that can't be sent
+            yet are re-ordered to minimize switching bus couplers.
+            ``None``: no limit.
+        :param max_burst: the number of requests for one coupler branch
+            that may be sent in a row if requests for other branches are
+            pending.
+        :param offline_writes: while the connection is down, buffer up to
+            this many writes instead of blocking, see :meth:`attr_set`.
+            Default: 0 (don't buffer).
     """
 
-    def __init__(self, service, host="localhost", port=4304, name=None):
+    def __init__(
+        self,
+        service,
+        host="localhost",
+        port=4304,
+        name=None,
+        max_inflight: Optional[int] = 8,
+        max_burst: int = 10,
+        offline_writes: int = 0,
+    ):
         self.service = service
         self.host = host
         self.port = port
@@ -40,16 +112,27 @@ class Server:
         self.stream = None
         self._msg_proto = None
         self.requests = deque()
-        self._wqueue_w, self._wqueue_r = anyio.create_memory_object_stream(100)
+        self.max_inflight = max_inflight
+        self._wqueue = MessageQueue(100, max_burst=max_burst)
+        self._replied = anyio.create_event()
+        self._last_reply = 0
         self._read_task = None
         self._write_task = None
         self._scan_task = None
         self._buses = dict()  # path => bus
+        self._all_buses = dict()  # path => bus, including sub-buses
         self._scan_lock = anyio.create_lock()
         self._scan_args = None
+        self._scan_cached = 0  # uncached scan every N cycles; 0: always
+        self._scan_count = 0
+        self._scan_failed = True  # first scan is always uncached
         self._backoff = 2
         self._current_tg = None
         self._current_run = None
+        self._online = False
+        self.offline_writes = offline_writes
+        self._offline = dict()  # path => _OfflineWrite
+        self._offline_seq = 0
 
     async def get_bus(self, *path):
         """Return the bus at this path. Allocate new if not existing."""
@@ -58,6 +141,7 @@ class Server:
         except KeyError:
             bus = Bus(self, *path)
             self._buses[bus.path] = bus
+            self._all_buses[bus.path] = bus
             await self.service.push_event(BusAdded(bus))
             return bus
 
@@ -85,9 +169,16 @@ class Server:
                         logger.debug("Server %s busy", self.host)
                     else:
                         msg = self.requests.popleft()
+                        now = await anyio.current_time()
+                        if msg.job is not None and msg.sent is not None:
+                            # owserver handles requests one at a time
+                            msg.job.bus_time += now - max(msg.sent, self._last_reply)
+                        self._last_reply = now
                         await msg.process_reply(res, data, self)
                         if not msg.done():
                             self.requests.appendleft(msg)
+                        evt, self._replied = self._replied, anyio.create_event()
+                        await evt.set()
         except anyio.ClosedResourceError:
             if self._current_tg is not None:
                 await self._current_tg.cancel_scope.cancel()
@@ -114,7 +205,7 @@ class Server:
                         msg = ml.popleft()
                         if not msg.cancelled:
                             try:
-                                await self._wqueue_w.send(msg)
+                                await self._wqueue.send(msg)
                             except BaseException:
                                 ml.appendleft(msg)
 
@@ -123,6 +214,7 @@ class Server:
                     raise
 
                 await self.chat(NOPMsg())
+                await self._flush_writes()
 
                 if self._scan_args is not None:
                     await tg.spawn(partial(self.start_scan, **self._scan_args))
@@ -133,6 +225,7 @@ class Server:
             pass  # exited tasks
 
         finally:
+            self._online = False
             self._current_tg = None
             if self.stream is not None:
                 async with anyio.open_cancel_scope(shield=True):
@@ -169,22 +262,41 @@ class Server:
                         if val is not None and not val.is_set():
                             await val.set_error(exc)
                             return
-                        logger.error("Disconnected")
+                    # the connection broke, or the server closed it
+                    logger.error("Disconnected")
+                    if val is not None and val.is_set():
                         val = None
+                    self._scan_failed = True
 
-                        await anyio.sleep(self._backoff)
-                        if self._backoff < 10:
-                            self._backoff *= 1.5
-                    else:
-                        pass
+                    await anyio.sleep(self._backoff)
+                    if self._backoff < 10:
+                        self._backoff *= 1.5
         finally:
             self._current_run = None
 
     async def setup_struct(self, dev):
         await dev.setup_struct(self)
 
+    @property
+    def branch_switches(self):
+        """The number of times requests switched between bus coupler branches"""
+        return self._wqueue.switches
+
+    async def submit(self, msg):
+        """Queue a message without waiting for the reply.
+
+        Messages are sent in the order they're submitted, unless they go
+        to different coupler branches. Await ``msg.get_reply()`` for the
+        result; if you stop waiting, cancel the message.
+
+        If this is called from a poll, the time owserver takes to answer is
+        charged to the poll's job, see :attr:`asyncowfs.scheduler.PollJob.bus_cost`.
+        """
+        msg.job = current_job()
+        await self._wqueue.send(msg)
+
     async def chat(self, msg):
-        await self._wqueue_w.send(msg)
+        await self.submit(msg)
         try:
             res = await msg.get_reply()
             return res
@@ -197,13 +309,16 @@ class Server:
             self._write_task = scope
             await evt.set()
             while True:
+                while self.max_inflight and len(self.requests) >= self.max_inflight:
+                    await self._replied.wait()
                 try:
                     async with anyio.fail_after(10):
-                        msg = await self._wqueue_r.receive()
+                        msg = await self._wqueue.receive()
                 except TimeoutError:
                     msg = NOPMsg()
 
                 self.requests.append(msg)
+                msg.sent = await anyio.current_time()
                 await msg.write(self._msg_proto)
 
     async def drop(self):
@@ -225,33 +340,49 @@ class Server:
             for b in list(self._buses.values()):
                 await b.delocate()
         self._buses = None
+        self._all_buses = None
         for m in self.requests:
             await m.cancel()
+        offline, self._offline = self._offline, dict()
+        for w in offline.values():
+            await w.done(CancelledError())
 
     @property
     def all_buses(self):
-        for b in list(self._buses.values()):
-            yield from b.all_buses
+        """All buses on this server, including those behind couplers.
+
+        This is a snapshot, so it's safe to await while iterating.
+        """
+        if self._all_buses is None:
+            return ()
+        return tuple(self._all_buses.values())
+
+    @property
+    def devices(self):
+        """All devices located on this server.
 
-    async def dir(self, *path):
-        return await self.chat(DirMsg(path))
+        This is a snapshot, so it's safe to await while iterating.
+        """
+        return self.service.devices_by_server(self)
+
+    async def dir(self, *path, cached=False):
+        return await self.chat(DirMsg(path, cached=cached))
 
     async def _scan(self, interval, initial_interval, polling, random=0):
         if not initial_interval:
             initial_interval = interval
         # 5% variation, to prevent clustering
         if random:
-            initial_interval *= 1 + (random() - 0.5) / random
+            initial_interval *= 1 + (_random() - 0.5) / random
         await anyio.sleep(initial_interval)
 
         while True:
-            async with self._scan_lock:
-                await self.scan_now(polling=polling)
+            await self.scan_now(polling=polling)
             if not interval:
                 return
             i = interval
             if random:
-                i *= 1 + (random() - 0.5) / random
+                i *= 1 + (_random() - 0.5) / random
             await anyio.sleep(i)
 
     async def scan_now(self, polling=True):
@@ -261,14 +392,34 @@ class Server:
                 pass
         else:
             async with self._scan_lock:
-                await self._scan_base(polling=polling)
+                cached = self._next_scan_cached()
+                try:
+                    ok = await self._scan_base(polling=polling, cached=cached)
+                except BaseException:
+                    # the next scan must not use the cache
+                    self._scan_failed = True
+                    raise
+                self._scan_failed = not ok
 
-    async def _scan_base(self, polling=True):
+    def _next_scan_cached(self):
+        """Decide whether the next scan may use owserver's cached directory.
+
+        Every ``_scan_cached``-th scan, as well as the first scan after an
+        error, runs a real (uncached) bus search.
+        """
+        n = self._scan_count
+        self._scan_count += 1
+        if not self._scan_cached or self._scan_failed:
+            self._scan_count = 1
+            return False
+        return n % self._scan_cached != 0
+
+    async def _scan_base(self, polling=True, cached=False):
         old_paths = set()
 
         # step 1: enumerate
         try:
-            for d in await self.dir():
+            for d in await self.dir(cached=cached):
                 if d.startswith("bus."):
                     bus = await self.get_bus(d)
                     bus._unseen = 0
@@ -276,10 +427,10 @@ class Server:
                         old_paths.remove(d)
                     except KeyError:
                         pass
-                    buses = await bus._scan_one(polling=polling)
+                    buses = await bus._scan_one(polling=polling, cached=cached)
                     old_paths -= buses
         except CancelledError:
-            return
+            return False
 
         # step 2: deregister buses, if not seen often enough
         for p in old_paths:
@@ -290,6 +441,7 @@ class Server:
                 await bus.delocate()
             else:
                 bus._unseen += 1
+        return True
 
     async def start_scan(
         self,
@@ -297,6 +449,7 @@ class Server:
         initial_scan: Union[float, bool] = True,
         polling=True,
         random: int = 0,
+        cached_scan: int = 0,
     ):
         """Scan this server.
 
@@ -311,8 +464,16 @@ class Server:
         :type initial_scan: :class:`float` or :class:`bool`
         :param polling: Flag whether to start tasks for periodic polling
             (alarm handling, temperature, …). Defaults to ``True``.
+        :param cached_scan: Flag whether re-scans may use owserver's cached
+            directory.
+            0: always run an uncached 1wire search (the default)
+            >0: run an uncached search every that many scans, as well as
+            after an error; otherwise read the cached directory.
         """
-        self._scan_args = dict(scan=scan, initial_scan=False, polling=polling, random=random)
+        self._scan_args = dict(
+            scan=scan, initial_scan=False, polling=polling, random=random, cached_scan=cached_scan
+        )
+        self._scan_cached = cached_scan
         if not scan and not initial_scan:
             return
         if scan and scan < 1:
@@ -329,5 +490,88 @@ class Server:
     async def attr_get(self, *path):
         return await self.chat(AttrGetMsg(*path))
 
-    async def attr_set(self, *path, value):
-        return await self.chat(AttrSetMsg(*path, value=value))
+    async def attr_set(self, *path, value, wait: bool = True, priority: int = 0, on_error=None):
+        """Write this attribute.
+
+        If the server has an offline buffer and the connection is down,
+        the write is buffered until it comes back. A buffered write to the
+        same path replaces the earlier one; both callers get its result.
+        When the connection is back, buffered writes are sent highest
+        ``priority`` first, and in order otherwise.
+
+        :param wait: if ``False``, return as soon as the write is queued.
+            Errors are then reported to ``on_error``, or logged.
+        :param priority: the order of flushing buffered writes.
+        :param on_error: called with the exception if a write that's not
+            waited for fails.
+        :raises WriteBufferFull: if the write would have to be buffered,
+            but the buffer is full.
+        """
+        if self.buffering:
+            w = self.buffer_write(path, value, priority)
+            if not wait:
+                if on_error is not None:
+                    w.on_error.append(on_error)
+                return None
+            return await w.get_reply()
+
+        msg = AttrSetMsg(*path, value=value)
+        if wait:
+            return await self.chat(msg)
+        await self.submit(msg)
+        await self.service.nursery.spawn(self._check_write, msg, on_error)
+        return None
+
+    @property
+    def buffering(self):
+        """Whether writes are buffered right now, see :meth:`attr_set`."""
+        return bool(self.offline_writes) and not self._online
+
+    def buffer_write(self, path, value, priority: int = 0):
+        """Add a write to the offline buffer, replacing a buffered write to
+        the same path. Await ``get_reply()`` on the result to wait for it.
+
+        :raises WriteBufferFull: if the buffer is full.
+        """
+        w = self._offline.get(path)
+        if w is None:
+            if len(self._offline) >= self.offline_writes:
+                raise WriteBufferFull(self, path)
+            self._offline_seq += 1
+            w = self._offline[path] = _OfflineWrite(path, value, priority, self._offline_seq)
+        else:
+            w.value = value
+            w.priority = max(w.priority, priority)
+        return w
+
+    async def _check_write(self, msg, on_error):
+        try:
+            await msg.get_reply()
+        except Exception as exc:  # pylint: disable=broad-except
+            if on_error is None:
+                logger.error("Write to %s failed: %r", msg, exc)
+            else:
+                on_error(exc)
+
+    async def _flush_writes(self):
+        """Send the buffered writes, then go online."""
+        msgs = []
+        while self._offline:
+            offline, self._offline = self._offline, dict()
+            for w in sorted(offline.values(), key=lambda w: (-w.priority, w.seq)):
+                msg = AttrSetMsg(*w.path, value=w.value)
+                await self.submit(msg)
+                msgs.append((msg, w))
+        self._online = True
+        if msgs:
+            # the replies may arrive after another reconnect
+            await self.service.nursery.spawn(self._collect_writes, msgs)
+
+    async def _collect_writes(self, msgs):
+        for msg, w in msgs:
+            try:
+                await msg.get_reply()
+            except Exception as exc:  # pylint: disable=broad-except
+                await w.done(exc)
+            else:
+                await w.done()
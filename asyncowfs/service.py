@@ -14,6 +14,11 @@ from .server import Server
 from .device import Device
 from .event import ServerRegistered, ServerDeregistered
 from .event import DeviceAdded, DeviceDeleted
+from . import bulk
+from .history import History
+from .registry import Registry
+from .scheduler import PollScheduler
+from .subscription import EventFilter, Subscription
 from .util import ValueEvent
 
 import logging
@@ -48,6 +53,27 @@ class Service:
 
         :param load_structs: Flag whether to generate accessors from OWFS data.
             Default: True
+
+        :param cached_scan: run an uncached bus search only every N scans
+            (and after errors), otherwise use owserver's cached directory.
+            Default: 0 (never use the cache)
+
+        :param poll_workers: the number of polls that may run concurrently.
+            Default: 10
+
+        :param slow_poll: if set, polls taking longer than this many seconds
+            run in a separate low-priority lane.
+            Default: None (all polls share the same workers)
+
+        :param aggregate_polls: if set, each simultaneous conversion on a
+            bus sends a single :class:`asyncowfs.event.BusValues` event
+            instead of one :class:`asyncowfs.event.DeviceValue` per device.
+            Default: False
+
+        :param history: keep this many recent values of each polled
+            attribute in ``self.history``, see
+            :class:`asyncowfs.history.History`.
+            Default: 0 (don't)
         """
 
     def __init__(
@@ -58,17 +84,27 @@ class Service:
         load_structs: bool = True,
         polling: bool = True,
         random: int = 0,
+        cached_scan: int = 0,
+        poll_workers: int = 10,
+        slow_poll: Optional[float] = None,
+        aggregate_polls: bool = False,
+        history: int = 0,
     ):
         self.nursery = nursery
         self._servers = set()  # typ.MutableSet[Server]  # Server
         self._devices = dict()  # ID => Device
+        self._registry = Registry()
         self._tasks = set()  # typ.MutableSet[]  # actually their cancel scopes
-        self._event_queue = None  # typ.Optional[anyio.Queue]
+        self._subscribers = ()  # Subscription
         self._random = random
         self._scan = scan
         self._initial_scan = initial_scan
         self._polling = polling
         self._load_structs = load_structs
+        self._cached_scan = cached_scan
+        self._poller = PollScheduler(self, workers=poll_workers, slow=slow_poll)
+        self.aggregate_polls = aggregate_polls
+        self.history = History(history) if history else None
 
     async def add_server(
         self,
@@ -79,12 +115,18 @@ class Service:
         initial_scan: Union[float, bool, None] = None,
         random: Optional[int] = None,
         name: str = None,
+        cached_scan: Optional[int] = None,
+        **kw
     ):
         """Add this server to the list.
 
         :param polling: if False, don't poll.
         :param scan: Override ``self._scan`` for this server.
         :param initial_scan: Override ``self._initial_scan`` for this server.
+        :param cached_scan: Override ``self._cached_scan`` for this server.
+
+        Other keyword arguments (``max_inflight``, ``max_burst``) are
+        passed to :class:`asyncowfs.server.Server`.
         """
         if scan is None:
             scan = self._scan
@@ -96,8 +138,10 @@ class Service:
             random = self._random
         if name is None:
             name = host
+        if cached_scan is None:
+            cached_scan = self._cached_scan
 
-        s = Server(self, host, port, name=name)
+        s = Server(self, host, port, name=name, **kw)
         await self.push_event(ServerRegistered(s))
         try:
             await s.start()
@@ -106,7 +150,13 @@ class Service:
             await self.push_event(ServerDeregistered(s))
             raise
         self._servers.add(s)
-        await s.start_scan(scan=scan, initial_scan=initial_scan, polling=polling, random=random)
+        await s.start_scan(
+            scan=scan,
+            initial_scan=initial_scan,
+            polling=polling,
+            random=random,
+            cached_scan=cached_scan,
+        )
         return s
 
     async def ensure_struct(self, dev, server=None, maybe=False):
@@ -141,6 +191,7 @@ class Service:
         except KeyError:
             dev = Device(self, id)
             self._devices[dev.id] = dev
+            self._registry.add_device(dev)
             await self.push_event(DeviceAdded(dev))
             return dev
 
@@ -176,12 +227,27 @@ class Service:
         self._tasks.add(scope)
         return scope
 
+    async def add_poll(self, proc, interval, first=None, random=0, isolate=True, bus=None):
+        """
+        Call ``proc`` every ``interval`` seconds. All polls share a small
+        pool of worker tasks, see :class:`asyncowfs.scheduler.PollScheduler`.
+
+        This call returns a :class:`asyncowfs.scheduler.PollJob`. Use its
+        ``cancel`` method to stop polling.
+        """
+        return await self._poller.add(
+            proc, interval, first=first, random=random, isolate=isolate, bus=bus
+        )
+
     async def push_event(self, event):
         """
-        Queue an event.
+        Queue an event to all subscribers that want it.
         """
-        if self._event_queue is not None:
-            await self._event_queue.send(event)
+        if self.history is not None:
+            self.history.record(event, await anyio.current_time())
+        for sub in self._subscribers:
+            if sub.filter is None or sub.filter(event):
+                await sub._send(event)
 
     async def _del_server(self, s):
         self._servers.remove(s)
@@ -198,6 +264,9 @@ class Service:
         if dev.bus is not None:
             raise RuntimeError("This device is present on %r" % (dev.bus,))
         del self._devices[dev.id]
+        self._registry.del_device(dev)
+        if self.history is not None:
+            self.history.drop(dev)
 
         await self.push_event(DeviceDeleted(dev))
 
@@ -205,6 +274,62 @@ class Service:
     def devices(self):
         return self._devices.values()
 
+    def devices_by_family(self, family: int, server=None):
+        """
+        Return all devices of this family.
+
+        :param server: if set, only return devices located on this server.
+        """
+        return self._registry.by_family(family, server=server)
+
+    def devices_by_server(self, server):
+        """
+        Return all devices located on this server.
+        """
+        return self._registry.by_server(server)
+
+    def devices_behind(self, coupler, branch: Optional[str] = None):
+        """
+        Return all devices behind this bus coupler, including those behind
+        couplers which are themselves connected to it.
+
+        :param coupler: the coupler device, or its ID.
+        :param branch: "main" or "aux". Default: both.
+        """
+        return self._registry.behind(coupler, branch)
+
+    # bulk access
+
+    async def read_many(self, items):
+        """
+        Read many attributes concurrently. ``items`` is a list of
+        (device, path) tuples.
+
+        Returns the results in order; a failed read's result is its
+        exception. See :func:`asyncowfs.bulk.read_each`.
+        """
+        return await bulk.read_many(self, items)
+
+    def read_each(self, items):
+        """
+        Read many attributes concurrently. This is an async context manager
+        returning an async iterator of (index, result) tuples, in the order
+        the reads complete. See :func:`asyncowfs.bulk.read_each`.
+        """
+        return bulk.read_each(self, items)
+
+    async def write_many(self, items, priority: int = 0):
+        """
+        Write many attributes. ``items`` is a list of
+        (device, path, value) tuples.
+
+        Writes are pipelined, in order per bus. Returns a list with
+        ``None`` for each successful write and the exception for each
+        failed one. ``priority`` applies to writes that end up in a
+        server's offline buffer. See :func:`asyncowfs.bulk.write_many`.
+        """
+        return await bulk.write_many(self, items, priority=priority)
+
     # context
 
     async def __aenter__(self):
@@ -213,46 +338,51 @@ class Service:
     async def __aexit__(self, *tb):
         for s in list(self._servers):
             await s.drop()
-        if self._event_queue is not None:
-            await self._event_queue.aclose()
+        for sub in self._subscribers:
+            await sub._close()
+        for dev in self._devices.values():
+            await dev._close_watches()
         for t in list(self._tasks):
             await t.cancel()
 
     # listen to events
 
+    def subscribe(
+        self,
+        *,
+        types=None,
+        family=None,
+        bus=None,
+        attribute=None,
+        max_len: int = 1000,
+        policy: str = "block",
+        timestamps: bool = False
+    ):
+        """
+        Return a new subscription to this service's events. Use it as an
+        async context manager, then iterate over it.
+
+        Any number of subscriptions may be active. Each has its own
+        buffer; events it doesn't want are never queued. See
+        :class:`asyncowfs.subscription.EventFilter` for the filter
+        arguments and :class:`asyncowfs.subscription.Subscription` for
+        the overflow ``policy`` and ``timestamps``.
+        """
+        f = None
+        if types is not None or family is not None or bus is not None or attribute is not None:
+            f = EventFilter(types=types, family=family, bus=bus, attribute=attribute)
+        return Subscription(self, f, max_len=max_len, policy=policy, timestamps=timestamps)
+
     @property
     def events(self):
-        class EventWrapper:
-            # pylint: disable=no-self-argument
-            _q_r = None
-
-            async def __aenter__(slf):
-                assert self._event_queue is None
-                self._event_queue, slf._q_r = anyio.create_memory_object_stream(1000)  # bus events
-                return slf
-
-            async def __aexit__(slf, *tb):
-                if tb[1] is None:
-                    try:
-                        while True:
-                            async with anyio.fail_after(0.01, shield=True):
-                                evt = await slf._q_r.receive()
-                            logger.error("Unprocessed: %s", evt)
-                    except TimeoutError:
-                        pass
-                self._event_queue = None
-
-            def __aiter__(slf):
-                return slf
-
-            async def __anext__(slf):
-                try:
-                    res = await slf._q_r.receive()
-                except anyio.EndOfStream:
-                    raise StopAsyncIteration  # pylint: disable=raise-missing-from
-                return res
+        """A subscription to all events."""
+        return self.subscribe()
+
+    def _add_subscriber(self, sub):
+        self._subscribers += (sub,)
 
-        return EventWrapper()
+    def _del_subscriber(self, sub):
+        self._subscribers = tuple(s for s in self._subscribers if s is not sub)
 
 
 @asynccontextmanager
@@ -0,0 +1,356 @@
+"""
+Event subscriptions.
+"""
+
+import anyio
+from collections import deque
+
+from .event import BusEvent, DeviceEvent, DeviceValue
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+__all__ = ["EventFilter", "Subscription", "Watch"]
+
+
+def _set(x):
+    if x is None:
+        return None
+    if isinstance(x, (str, int)):
+        return frozenset((x,))
+    return frozenset(x)
+
+
+class EventFilter:
+    """Selects the events a subscriber is interested in.
+
+    All criteria that are set must match. An event that doesn't carry the
+    information a criterion needs (e.g. a server event, when filtering by
+    device family) doesn't match.
+
+    :param types: an event class, or a tuple of them.
+    :param family: a device family code, or a collection of them.
+    :param bus: a bus path (or :class:`asyncowfs.bus.Bus`). Matches
+        events of that bus, the buses behind it, and devices on them.
+    :param attribute: the ``attribute`` of a
+        :class:`asyncowfs.event.DeviceValue` or
+        :class:`asyncowfs.event.DeviceException`, or a collection of them.
+    """
+
+    def __init__(self, types=None, family=None, bus=None, attribute=None):
+        self.types = types
+        self.family = _set(family)
+        self.bus = None if bus is None else tuple(getattr(bus, "path", bus))
+        self.attribute = _set(attribute)
+
+    def __repr__(self):
+        return "<%s %s>" % (
+            self.__class__.__name__,
+            " ".join(
+                "%s=%s" % (k, v)
+                for k, v in (
+                    ("types", self.types),
+                    ("family", self.family),
+                    ("bus", self.bus),
+                    ("attribute", self.attribute),
+                )
+                if v is not None
+            ),
+        )
+
+    def __call__(self, event):
+        if self.types is not None and not isinstance(event, self.types):
+            return False
+        if self.family is not None:
+            dev = getattr(event, "device", None)
+            if dev is None or dev.family not in self.family:
+                return False
+        if self.attribute is not None:
+            if getattr(event, "attribute", None) not in self.attribute:
+                return False
+        if self.bus is not None:
+            if isinstance(event, BusEvent):
+                bus = event.bus
+            elif isinstance(event, DeviceEvent):
+                bus = event.device.bus
+            else:
+                return False
+            if bus is None or bus.path[: len(self.bus)] != self.bus:
+                return False
+        return True
+
+
+class Subscription:
+    """A stream of events, as returned by
+    :meth:`asyncowfs.service.Service.subscribe`.
+
+    Use as an async context manager, then iterate over it::
+
+        async with service.subscribe(family=0x10) as events:
+            async for evt in events:
+                ...
+
+    Events are filtered before they're queued. Each subscription has its
+    own buffer of ``max_len`` events. What happens when it's full depends
+    on ``policy``:
+
+    * "block": the producer waits until there's room. This means that a
+      slow subscriber slows down polling, scanning etc. for everybody.
+    * "drop_oldest": the oldest queued event is discarded.
+    * "conflate": a :class:`asyncowfs.event.DeviceValue` replaces a queued
+      value for the same device and attribute, even if the buffer isn't
+      full; the replacement keeps its predecessor's place in the queue.
+      If the buffer is full anyway, the oldest event is discarded.
+
+    ``dropped`` and ``conflated`` count the events that were discarded or
+    replaced.
+
+    If ``timestamps`` is set, events are returned as ``(time, event)``
+    tuples, ``time`` being when the event was sent.
+    """
+
+    POLICIES = ("block", "drop_oldest", "conflate")
+
+    dropped = 0
+    conflated = 0
+
+    def __init__(
+        self,
+        service,
+        filter=None,  # pylint: disable=redefined-builtin
+        max_len: int = 1000,
+        policy: str = "block",
+        timestamps: bool = False,
+    ):
+        if policy not in self.POLICIES:
+            raise ValueError(policy)
+        self.service = service
+        self.filter = filter
+        self.max_len = max_len
+        self.policy = policy
+        self.timestamps = timestamps
+        self._buf = None  # deque of [event, key, time]
+        self._keyed = dict()  # key => queued [event, key]
+        self._closed = False
+        self._want = None  # wake the receiver when this many are queued
+        self._readable = anyio.create_event()
+        self._writable = anyio.create_event()
+
+    def __repr__(self):
+        return "<%s %s %s>" % (self.__class__.__name__, self.policy, self.filter)
+
+    def __len__(self):
+        """The number of queued events"""
+        return len(self._buf) if self._buf is not None else 0
+
+    async def __aenter__(self):
+        if self._buf is not None:
+            raise RuntimeError("A subscription can only be used once")
+        self._buf = deque()
+        self.service._add_subscriber(self)
+        return self
+
+    async def __aexit__(self, *tb):
+        self.service._del_subscriber(self)
+        if tb[1] is None:
+            for evt, _, _ in self._buf:
+                logger.error("Unprocessed: %s", evt)
+        self._buf.clear()
+        self._keyed.clear()
+        await self._close()
+
+    def _pop(self):
+        cell = self._buf.popleft()
+        if cell[1] is not None:
+            del self._keyed[cell[1]]
+        if self.timestamps:
+            return cell[2], cell[0]
+        return cell[0]
+
+    async def _send(self, event):
+        if self._closed:
+            return  # unsubscribed
+        t = await anyio.current_time() if self.timestamps else None
+        key = None
+        if self.policy == "conflate" and isinstance(event, DeviceValue):
+            key = (event.device, event.attribute)
+            cell = self._keyed.get(key)
+            if cell is not None:
+                cell[0] = event
+                cell[2] = t
+                self.conflated += 1
+                return
+
+        if len(self._buf) >= self.max_len:
+            if self.policy == "block":
+                while len(self._buf) >= self.max_len:
+                    await self._writable.wait()
+                    if self._closed:
+                        return
+            else:
+                self._pop()
+                self.dropped += 1
+
+        cell = [event, key, t]
+        self._buf.append(cell)
+        if key is not None:
+            self._keyed[key] = cell
+        if self._want is not None and len(self._buf) >= self._want:
+            self._want = None
+            evt, self._readable = self._readable, anyio.create_event()
+            await evt.set()
+
+    async def _close(self):
+        """No more events will arrive."""
+        if self._closed:
+            return
+        self._closed = True
+        await self._readable.set()
+        await self._writable.set()
+
+    async def _wait(self, n):
+        self._want = n
+        try:
+            await self._readable.wait()
+        finally:
+            self._want = None
+
+    async def receive(self):
+        """Return the next event.
+
+        :raises anyio.EndOfStream: if the service has been closed.
+        """
+        while not self._buf:
+            if self._closed:
+                raise anyio.EndOfStream
+            await self._wait(1)
+        evt = self._pop()
+        if self.policy == "block" and len(self._buf) == self.max_len - 1:
+            e, self._writable = self._writable, anyio.create_event()
+            await e.set()
+        return evt
+
+    async def receive_batch(self, max_n: int = 100, max_wait: float = 0):
+        """Return a list of up to ``max_n`` events.
+
+        This waits for the first event, then up to ``max_wait`` seconds
+        for more to arrive, but returns early when ``max_n`` are queued.
+
+        :raises anyio.EndOfStream: if the service has been closed and no
+            events are left.
+        """
+        while not self._buf:
+            if self._closed:
+                raise anyio.EndOfStream
+            await self._wait(1)
+        if max_wait > 0 and len(self._buf) < max_n:
+            async with anyio.move_on_after(max_wait):
+                while len(self._buf) < max_n and not self._closed:
+                    await self._wait(max_n)
+        was_full = len(self._buf) >= self.max_len
+        res = []
+        while self._buf and len(res) < max_n:
+            res.append(self._pop())
+        if self.policy == "block" and was_full:
+            e, self._writable = self._writable, anyio.create_event()
+            await e.set()
+        return res
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        try:
+            res = await self.receive()
+        except anyio.EndOfStream:
+            raise StopAsyncIteration  # pylint: disable=raise-missing-from
+        return res
+
+
+class Watch:
+    """The values of one attribute, as returned by
+    :meth:`asyncowfs.device.Device.watch`.
+
+    Use as an async context manager, then iterate over it::
+
+        async with dev.watch("temperature", 10) as temps:
+            async for t in temps:
+                ...
+
+    All watches of an attribute share a single poll, which runs at the
+    shortest interval any of them asks for. A watch yields at most one
+    value per ``interval`` seconds; if more arrive, only the latest is
+    kept. ``conflated`` counts the values that were skipped. A failed read
+    yields the exception.
+
+    The iterator ends when the service is closed.
+    """
+
+    conflated = 0
+
+    def __init__(self, device, path, interval: float):
+        if interval <= 0:
+            raise ValueError(interval)
+        self.device = device
+        self.path = path
+        self.interval = interval
+        self._value = None
+        self._has_value = False
+        self._last = None  # when the last value was delivered
+        self._active = None
+        self._readable = anyio.create_event()
+
+    def __repr__(self):
+        return "<%s %s %s @%s>" % (
+            self.__class__.__name__,
+            self.device,
+            "/".join(str(p) for p in self.path),
+            self.interval,
+        )
+
+    async def __aenter__(self):
+        if self._active is not None:
+            raise RuntimeError("A watch can only be used once")
+        self._active = True
+        await self.device._add_watch(self)
+        return self
+
+    async def __aexit__(self, *tb):
+        await self._close()
+        await self.device._del_watch(self)
+
+    async def _send(self, value):
+        if self._has_value:
+            self.conflated += 1
+        self._value = value
+        self._has_value = True
+        evt, self._readable = self._readable, anyio.create_event()
+        await evt.set()
+
+    async def _close(self):
+        self._active = False
+        await self._readable.set()
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        while True:
+            if not self._active:
+                raise StopAsyncIteration
+            if not self._has_value:
+                await self._readable.wait()
+                continue
+            if self._last is not None:
+                delay = self._last + self.interval - await anyio.current_time()
+                if delay > 0:
+                    # newer values may replace the current one meanwhile
+                    async with anyio.move_on_after(delay):
+                        while self._active:
+                            await self._readable.wait()
+                    continue
+            self._last = await anyio.current_time()
+            self._has_value = False
+            value, self._value = self._value, None
+            return value
@@ -1,13 +1,16 @@
 # utility code
 
-import attr
-import outcome
-
 import anyio
 from concurrent.futures import CancelledError
 
 
-@attr.s
+def split_path(path):
+    """Convert ``"volt/0"`` or ``("volt", "0")`` to ``("volt", 0)``."""
+    if isinstance(path, str):
+        path = path.split("/")
+    return tuple(int(p) if isinstance(p, str) and p.isdigit() else p for p in path)
+
+
 class ValueEvent:
     """A waitable value useful for inter-task synchronization,
     inspired by :class:`threading.Event`.
@@ -15,23 +18,41 @@ class ValueEvent:
     An event object manages an internal value, which is initially
     unset, and tasks can wait for it to become True.
 
+    This is used once per request, so it is kept small: the underlying
+    anyio event is only created if somebody needs to wait for it.
     """
 
-    event = attr.ib(factory=anyio.create_event, init=False)
-    value = attr.ib(default=None, init=False)
+    __slots__ = ("_event", "_value", "_error", "_set")
+
+    def __init__(self):
+        self._event = None
+        self._value = None
+        self._error = None
+        self._set = False
+
+    def __repr__(self):
+        if not self._set:
+            return "<%s>" % (self.__class__.__name__,)
+        if self._error is not None:
+            return "<%s !%r>" % (self.__class__.__name__, self._error)
+        return "<%s =%r>" % (self.__class__.__name__, self._value)
 
     async def set(self, value):
         """Set the internal flag value to True, and wake any waiting tasks."""
-        self.value = outcome.Value(value)
-        await self.event.set()
+        self._value = value
+        self._set = True
+        if self._event is not None:
+            await self._event.set()
 
     def is_set(self):
-        return self.value is not None
+        return self._set
 
     async def set_error(self, exc):
         """Set the internal flag value to True, and wake any waiting tasks."""
-        self.value = outcome.Error(exc)
-        await self.event.set()
+        self._error = exc
+        self._set = True
+        if self._event is not None:
+            await self._event.set()
 
     async def cancel(self):
         await self.set_error(CancelledError())
@@ -43,5 +64,12 @@ class ValueEvent:
         otherwise returns immediately.
 
         """
-        await self.event.wait()
-        return self.value.unwrap()
+        if self._set:
+            await anyio.sleep(0)
+        else:
+            if self._event is None:
+                self._event = anyio.create_event()
+            await self._event.wait()
+        if self._error is not None:
+            raise self._error
+        return self._value
@@ -0,0 +1,107 @@
+"""objects.py -- benchmark event and request objects
+
+Compares the slotted event classes, messages and ValueEvent with
+dict-based equivalents, built the way they were before they were
+slotted: memory per object (via tracemalloc) and the time to create
+one, respectively to complete and collect a request.
+
+Usage::
+
+    python3 bench/objects.py [num_objects]
+
+No owserver is required.
+"""
+
+import sys
+import time
+import tracemalloc
+
+import anyio
+import attr
+import outcome
+
+from asyncowfs.event import DeviceValue
+from asyncowfs.protocol import AttrGetMsg, OWMsg, _path
+from asyncowfs.util import ValueEvent
+
+
+@attr.s
+class OldDeviceEvent:
+    device = attr.ib()
+
+
+@attr.s
+class OldDeviceValue(OldDeviceEvent):
+    attribute = attr.ib()
+    value = attr.ib()
+    late = attr.ib(default=0, eq=False)
+
+
+@attr.s
+class OldValueEvent:
+    event = attr.ib(factory=anyio.create_event, init=False)
+    value = attr.ib(default=None, init=False)
+
+    async def set(self, value):
+        self.value = outcome.Value(value)
+        await self.event.set()
+
+    async def get(self):
+        await self.event.wait()
+        return self.value.unwrap()
+
+
+class OldAttrGetMsg:
+    timeout = 2
+    cancelled = False
+    cached = False
+
+    def __init__(self, *path):
+        self.path = path
+        self.typ = OWMsg.read
+        self.data = _path(path)
+        self.rlen = 8192
+        self.event = OldValueEvent()
+        self._id = 0
+
+
+def measure(name, make, n):
+    tracemalloc.start()
+    t = time.perf_counter()
+    objs = [make(i) for i in range(n)]
+    t = time.perf_counter() - t
+    size, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    print("%-24s %8.1f bytes %8.2f µs" % (name, size / n, t / n * 1e6))
+    del objs
+
+
+async def roundtrip(name, make, n):
+    t = time.perf_counter()
+    for i in range(n):
+        msg = make(i)
+        await msg.event.set(i)
+        await msg.event.get()
+    t = time.perf_counter() - t
+    print("%-24s %8.2f µs per request" % (name, t / n * 1e6))
+
+
+async def main(n=100000):
+    dev = object()
+    assert not hasattr(DeviceValue(dev, "x", 1), "__dict__")
+
+    print("Memory and creation time per object:")
+    measure("DeviceValue, attr dict", lambda i: OldDeviceValue(dev, "temperature", i), n)
+    measure("DeviceValue, slotted", lambda i: DeviceValue(dev, "temperature", i), n)
+    measure("AttrGetMsg, dict", lambda i: OldAttrGetMsg("bus.0", "10.345678.90", "x"), n)
+    measure("AttrGetMsg, slotted", lambda i: AttrGetMsg("bus.0", "10.345678.90", "x"), n)
+    measure("ValueEvent, attr+event", lambda i: OldValueEvent(), n)
+    measure("ValueEvent, lazy", lambda i: ValueEvent(), n)
+
+    print("Completing a request:")
+    await roundtrip("attr+event+outcome", lambda i: OldAttrGetMsg("bus.0", "x"), n)
+    await roundtrip("slotted, lazy", lambda i: AttrGetMsg("bus.0", "x"), n)
+
+
+if __name__ == "__main__":
+    anyio.run(main, *(int(x) for x in sys.argv[1:2]), backend="trio")
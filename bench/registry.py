@@ -0,0 +1,86 @@
+"""registry.py -- benchmark the device indexes
+
+Builds a registry of 10000 devices (by default) on one fake server, spread
+over a number of buses and DS2409 coupler branches, then compares indexed
+queries with walking the bus tree.
+
+Usage::
+
+    python3 bench/registry.py [num_devices]
+
+No owserver is required.
+"""
+
+import sys
+import time
+
+import anyio
+
+from asyncowfs.service import Service
+from asyncowfs.server import Server
+
+FAMILIES = (0x10, 0x20, 0x28, 0x05)
+
+
+def timed(name, proc, n=100):
+    t = time.perf_counter()
+    for _ in range(n):
+        res = proc()
+    t = (time.perf_counter() - t) / n
+    print("%-32s %10.1f µs  (%d results)" % (name, t * 1e6, len(res)))
+
+
+async def main(num=10000, buses=10, couplers=20):
+    ow = Service(None)
+    s = Server(ow, "bench")
+    ow._servers.add(s)
+
+    t = time.perf_counter()
+    branches = []
+    for b in range(buses):
+        bus = await s.get_bus("bus.%d" % b)
+        branches.append(bus)
+        for c in range(couplers):
+            cid = "1F.%06X.%02X" % (b * 100 + c, c)
+            dev = await ow.get_device(cid)
+            await bus.add_device(dev)
+            for br in dev.buses():
+                branches.append(await bus.get_bus(*br))
+    for i in range(num):
+        dev = await ow.get_device("%02X.%06X.%02X" % (FAMILIES[i % len(FAMILIES)], i, i % 256))
+        await branches[i % len(branches)].add_device(dev)
+    t = time.perf_counter() - t
+    print("Built %d devices on %d buses in %.3f s" % (num, len(branches), t))
+
+    coupler = "1F.%06X.%02X" % (0, 0)
+
+    def walk_family():
+        return [d for b in s.all_buses for d in b.devices if d.family == 0x28]
+
+    def walk_behind():
+        return [
+            d
+            for b in s.all_buses
+            if coupler in b.path
+            for d in b.devices
+        ]
+
+    timed("walk: family 0x28 on server", walk_family)
+    timed("index: family 0x28 on server", lambda: ow.devices_by_family(0x28, server=s))
+    timed("walk: behind coupler", walk_behind)
+    timed("index: behind coupler", lambda: ow.devices_behind(coupler))
+    timed("index: behind coupler, aux", lambda: ow.devices_behind(coupler, "aux"))
+    timed("index: server", lambda: s.devices)
+
+    dev = await ow.get_device("28.%06X.%02X" % (2, 2))
+    bus = dev.bus
+    t = time.perf_counter()
+    for _ in range(1000):
+        await dev.delocate(bus)
+        await bus.add_device(dev)
+    t = (time.perf_counter() - t) / 1000
+    print("%-32s %10.1f µs" % ("delocate + add_device", t * 1e6))
+
+
+if __name__ == "__main__":
+    anyio.run(main, *(int(x) for x in sys.argv[1:2]), backend="trio")
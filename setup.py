@@ -31,6 +31,7 @@ setup(
     license="MIT -or- Apache License 2.0",
     packages=find_packages(),
     install_requires=["anyio >=2"],
+    extras_require={"numpy": ["numpy"]},
     keywords=["trio", "async", "io", "networking"],
     python_requires=">=3.5.3",
     classifiers=[
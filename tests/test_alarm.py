@@ -68,3 +68,72 @@ async def test_alarm(mock_clock):
         assert int(dt["templow"]) == 11
         assert dev.alarm_temperature == 12.5
         await trio.sleep(5)  # allow temperature poll to trigger
+
+
+async def test_simul_temperature(mock_clock):
+    mock_clock.autojump_threshold = 0.1
+    my_tree = {
+        "bus.0": {
+            "simultaneous": {"temperature": 0},
+            "10.345678.90": {"latesttemp": "12.5", "temperature": "99"},
+            "28.282828.28": {"latesttemp": "20.25", "temperature": "99"},
+        },
+        "structure": structs,
+    }
+    values = []
+
+    async def rdr(ow, evt):
+        async with ow.events as ev:
+            await evt.set()
+            async for e in ev:
+                if e is None:
+                    break
+                if isinstance(e, DeviceValue):
+                    values.append((e.device.id, e.attribute, e.value))
+
+    async with server(tree=my_tree, events=rdr) as ow:
+        for d in ("10.345678.90", "28.282828.28"):
+            dev = await ow.get_device(d)
+            await dev.set_polling_interval("temperature", 10)
+        await trio.sleep(11)
+        assert my_tree["bus.0"]["simultaneous"]["temperature"] == "1"
+
+    assert sorted(values) == [
+        ("10.345678.90", "temperature", 12.5),
+        ("28.282828.28", "temperature", 20.25),
+    ]
+
+
+async def test_simul_voltage(mock_clock):
+    mock_clock.autojump_threshold = 0.1
+    my_tree = {
+        "bus.0": {
+            "simultaneous": {"voltage": 0},
+            "20.222222.22": {"latestvolt.ALL": "1.5,2.5,3.5,4.5", "volt.ALL": "0,0,0,0"},
+        },
+        "structure": structs,
+    }
+    values = []
+
+    async def rdr(ow, evt):
+        async with ow.events as ev:
+            await evt.set()
+            async for e in ev:
+                if e is None:
+                    break
+                if isinstance(e, DeviceValue):
+                    values.append((e.device.id, e.attribute, e.value))
+
+    async with server(tree=my_tree, events=rdr) as ow:
+        dev = await ow.get_device("20.222222.22")
+        dev.bus.set_conversion_delay("voltage", 0.1)
+        await dev.set_polling_interval("voltage", 10)
+        await trio.sleep(11)
+        assert my_tree["bus.0"]["simultaneous"]["voltage"] == "1"
+
+        await dev.poll_voltage()
+
+    assert values == [
+        ("20.222222.22", "voltage", [1.5, 2.5, 3.5, 4.5]),
+        ("20.222222.22", "voltage", [0.0, 0.0, 0.0, 0.0]),
+    ]
@@ -0,0 +1,99 @@
+from copy import deepcopy
+
+from asyncowfs.device import NoLocationKnown
+from asyncowfs.mock import server, structs
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+basic_tree = {
+    "bus.0": {
+        "10.345678.90": {"latesttemp": "12.5", "temphigh": "20", "templow": "15"},
+        "10.345678.91": {"latesttemp": "13.5", "temphigh": "21", "templow": "16"},
+        "20.222222.22": {"volt.ALL": "1.5,2.5,0,5", "volt.A": "1.5", "volt.B": "2.5"},
+    },
+    "structure": structs,
+}
+
+
+async def test_read_many(mock_clock):
+    mock_clock.autojump_threshold = 0.1
+    async with server(tree=deepcopy(basic_tree)) as ow:
+        d0 = await ow.get_device("10.345678.90")
+        d1 = await ow.get_device("10.345678.91")
+        gone = await ow.get_device("10.345678.99")
+        items = [
+            (d0, "temphigh"),
+            ("10.345678.91", "templow"),
+            (d1, ("temphigh",)),
+            (gone, "temphigh"),
+            ("20.222222.22", "volt/1"),
+            ("20.222222.22", "volt_all"),
+            (d0, "temphigh"),
+        ]
+        res = await ow.read_many(items)
+        assert res[:3] == [20, 16, 21]
+        assert isinstance(res[3], NoLocationKnown)
+        assert res[4:] == [2.5, [1.5, 2.5, 0, 5], 20]
+
+        assert await d0.get_many("templow", "temphigh") == [15, 20]
+
+        seen = []
+        async with ow.read_each(items) as results:
+            async for i, r in results:
+                seen.append(i)
+        assert sorted(seen) == list(range(len(items)))
+
+
+async def test_write_many(mock_clock):
+    mock_clock.autojump_threshold = 0.1
+    tree = deepcopy(basic_tree)
+    alarm = tree["bus.0"]["20.222222.22"]["set_alarm"] = {
+        "volthigh.ALL": "5,5,5,5",
+        "volthigh.A": "5",
+        "volthigh.B": "5",
+        "volthigh.C": "5",
+        "volthigh.D": "5",
+    }
+    async with server(tree=tree) as ow:
+        d0 = await ow.get_device("10.345678.90")
+        gone = await ow.get_device("10.345678.99")
+        items = [
+            (d0, "temphigh", 30),
+            ("20.222222.22", "set_alarm/volthigh/2", 3),
+            ("10.345678.91", "templow", 11),
+            (gone, "temphigh", 25),
+            ("20.222222.22", "set_alarm/volthigh/0", 1),
+            ("20.222222.22", "set_alarm/volthigh/1", 2),
+            (d0, "temphigh", 31),
+            ("20.222222.22", "set_alarm/volthigh/3", 4),
+        ]
+        res = await ow.write_many(items)
+        assert res[:3] == [None] * 3
+        assert isinstance(res[3], NoLocationKnown)
+        assert res[4:] == [None] * 4
+
+        # same device: order is preserved
+        assert tree["bus.0"]["10.345678.90"]["temphigh"] == "31"
+        assert tree["bus.0"]["10.345678.91"]["templow"] == "11"
+        # four element writes became a single array write
+        assert alarm["volthigh.ALL"] == "1,2,3,4"
+        assert alarm["volthigh.A"] == "5"
+
+        res = await ow.write_many([("20.222222.22", "set_alarm/volthigh/1", 7)])
+        assert res == [None]
+        assert alarm["volthigh.B"] == "7"
+
+        # an element that's written twice: the last value wins
+        items = [
+            ("20.222222.22", "set_alarm/volthigh/1", 2),
+            ("20.222222.22", "set_alarm/volthigh/0", 1),
+            ("20.222222.22", "set_alarm/volthigh/2", 3),
+            ("20.222222.22", "set_alarm/volthigh/3", 4),
+            ("20.222222.22", "set_alarm/volthigh/0", 9),
+        ]
+        alarm["volthigh.A"] = "5"
+        assert await ow.write_many(items) == [None] * 5
+        assert alarm["volthigh.ALL"] == "9,2,3,4"
+        assert alarm["volthigh.A"] == "5"
@@ -0,0 +1,162 @@
+import trio
+from copy import deepcopy
+
+from asyncowfs.event import BusValues, DeviceValue, DeviceLocated, ServerConnected
+from asyncowfs.mock import server, structs
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+basic_tree = {
+    "bus.0": {
+        "simultaneous": {"temperature": 0},
+        "10.345678.90": {"latesttemp": "12.5", "temphigh": "20", "templow": "15"},
+        "28.282828.28": {"latesttemp": "20.25", "temphigh": "30", "templow": "10"},
+    },
+    "structure": structs,
+}
+
+
+class Recorder:
+    """Record the events of one subscription"""
+
+    def __init__(self, **kw):
+        self.kw = kw
+        self.events = []
+
+    async def __call__(self, ow, task_status=trio.TASK_STATUS_IGNORED):
+        async with ow.subscribe(**self.kw) as ev:
+            task_status.started()
+            async for e in ev:
+                self.events.append(e)
+
+
+def recorders(*recs):
+    """Start some recorders before the mock server connects"""
+
+    async def run(ow, evt):
+        async with trio.open_nursery() as n:
+            for r in recs:
+                await n.start(r, ow)
+            await evt.set()
+
+    return run
+
+
+async def test_fanout(mock_clock):
+    mock_clock.autojump_threshold = 0.1
+    everything = Recorder()
+    values = Recorder(types=DeviceValue, family=0x10, attribute="temphigh")
+    located = Recorder(types=DeviceLocated, bus=("bus.0",))
+    elsewhere = Recorder(bus=("bus.1",))
+    evts = recorders(everything, values, located, elsewhere)
+
+    async with server(tree=deepcopy(basic_tree), events=evts) as ow:
+        for d in ("10.345678.90", "28.282828.28"):
+            dev = await ow.get_device(d)
+            await dev.set_polling_interval("temphigh", 10)
+            await dev.set_polling_interval("templow", 10)
+        await trio.sleep(15)
+
+    assert any(isinstance(e, ServerConnected) for e in everything.events)
+    res = {(e.device.id, e.attribute) for e in everything.events if isinstance(e, DeviceValue)}
+    assert len(res) == 4
+    assert {(e.device.id, e.attribute) for e in values.events} == {("10.345678.90", "temphigh")}
+    assert sorted(e.device.id for e in located.events) == ["10.345678.90", "28.282828.28"]
+    assert elsewhere.events == []
+
+
+async def test_overflow(mock_clock):
+    mock_clock.autojump_threshold = 0.1
+    async with server(tree=deepcopy(basic_tree)) as ow:
+        d1 = await ow.get_device("10.345678.90")
+        d2 = await ow.get_device("28.282828.28")
+
+        async with ow.subscribe(types=DeviceValue, max_len=3, policy="drop_oldest") as sub:
+            for i in range(5):
+                await ow.push_event(DeviceValue(d1, "temphigh", i))
+            assert sub.dropped == 2
+            assert [(await sub.receive()).value for _ in range(3)] == [2, 3, 4]
+
+        async with ow.subscribe(types=DeviceValue, max_len=3, policy="conflate") as sub:
+            for i in range(5):
+                await ow.push_event(DeviceValue(d1, "temphigh", i))
+                await ow.push_event(DeviceValue(d2, "temphigh", i))
+            await ow.push_event(DeviceValue(d1, "templow", 9))
+            assert len(sub) == 3
+            assert sub.conflated == 8
+            assert sub.dropped == 0
+            res = [await sub.receive() for _ in range(3)]
+            assert [(e.device.id, e.attribute, e.value) for e in res] == [
+                ("10.345678.90", "temphigh", 4),
+                ("28.282828.28", "temphigh", 4),
+                ("10.345678.90", "templow", 9),
+            ]
+
+        async with ow.subscribe(types=DeviceValue, max_len=2) as sub:
+            for i in range(2):
+                await ow.push_event(DeviceValue(d1, "temphigh", i))
+            with trio.move_on_after(1) as cs:
+                await ow.push_event(DeviceValue(d1, "temphigh", 2))
+            assert cs.cancelled_caught
+            assert (await sub.receive()).value == 0
+            await ow.push_event(DeviceValue(d1, "temphigh", 3))
+            assert [(await sub.receive()).value for _ in range(2)] == [1, 3]
+
+
+async def test_batch(mock_clock):
+    mock_clock.autojump_threshold = 0.1
+    async with server(tree=deepcopy(basic_tree)) as ow:
+        dev = await ow.get_device("10.345678.90")
+
+        async with ow.subscribe(types=DeviceValue) as sub:
+            for i in range(5):
+                await ow.push_event(DeviceValue(dev, "temphigh", i))
+            res = await sub.receive_batch(3)
+            assert [e.value for e in res] == [0, 1, 2]
+            res = await sub.receive_batch(3)
+            assert [e.value for e in res] == [3, 4]
+
+            async def produce():
+                for i in range(10):
+                    await trio.sleep(1)
+                    await ow.push_event(DeviceValue(dev, "temphigh", i))
+
+            async with trio.open_nursery() as n:
+                n.start_soon(produce)
+                t = trio.current_time()
+                res = await sub.receive_batch(3, max_wait=10)
+                assert [e.value for e in res] == [0, 1, 2]
+                assert trio.current_time() - t == 3
+                res = await sub.receive_batch(10, max_wait=2.5)
+                assert [e.value for e in res] == [3, 4, 5]
+
+        async with ow.subscribe(types=DeviceValue, timestamps=True) as sub:
+            t = trio.current_time()
+            for i in range(3):
+                await ow.push_event(DeviceValue(dev, "temphigh", i))
+                await trio.sleep(1)
+            res = await sub.receive_batch(3)
+            assert [(t2 - t, e.value) for t2, e in res] == [(0, 0), (1, 1), (2, 2)]
+
+
+async def test_aggregate(mock_clock):
+    mock_clock.autojump_threshold = 0.1
+    my_tree = deepcopy(basic_tree)
+    my_tree["bus.0"]["10.345678.91"] = {"latesttemp": "13.5", "temperature": "99"}
+
+    async with server(tree=my_tree, aggregate_polls=True) as ow:
+        async with ow.subscribe(types=(DeviceValue, BusValues)) as sub:
+            for d in ("10.345678.90", "10.345678.91", "28.282828.28"):
+                dev = await ow.get_device(d)
+                await dev.set_polling_interval("temperature", 10)
+            res = await sub.receive()
+            assert isinstance(res, BusValues)
+            assert res.attribute == "temperature"
+            assert {d.id: v for d, v in res.values.items()} == {
+                "10.345678.90": 12.5,
+                "10.345678.91": 13.5,
+                "28.282828.28": 20.25,
+            }
+            assert len(sub) == 0
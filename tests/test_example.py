@@ -448,3 +448,68 @@ async def test_manual_bus(mock_clock):
         await dev.locate(bus)
         assert dev.bus is not None
         assert float(await dev.attr_get("temperature")) == 12.5
+
+
+async def test_cached_scan(mock_clock):
+    mock_clock.autojump_threshold = 0.1
+    dir_log = []
+    my_tree = deepcopy(basic_tree)
+    async with server(tree=my_tree, options={"dir_log": dir_log}, cached_scan=3) as ow:
+        dev = await ow.get_device("10.345678.90")
+        del my_tree["bus.0"]["10.345678.90"]
+        for _ in range(3):
+            await ow.scan_now(polling=False)
+        # hysteresis works the same in both modes
+        assert dev._unseen == 3
+        assert dev.bus is not None
+        await ow.scan_now(polling=False)
+        assert dev.bus is None
+
+        # initial scan, two cached scans, uncached verification, cached
+        assert [u for p, u in dir_log if p == "/"] == [True, False, False, True, False]
+        assert [u for p, u in dir_log if p == "/bus.0"] == [True, False, False, True, False]
+
+
+async def test_registry(mock_clock):
+    mock_clock.autojump_threshold = 0.1
+    my_tree = deepcopy(coupler_tree)
+    async with server(tree=my_tree) as ow:
+        s = ow.test_server
+        assert set(d.id for d in ow.devices_by_family(0x28)) == {"28.282828.28"}
+        assert set(d.id for d in ow.devices_by_family(0x28, server=s)) == {"28.282828.28"}
+        assert len(s.devices) == 4
+        assert set(d.id for d in ow.devices_behind("1F.ABCDEF.F1", "aux")) == {"28.282828.28"}
+        assert set(d.id for d in ow.devices_behind("1F.abcdef.f1")) == {
+            "20.222222.22",
+            "28.282828.28",
+        }
+        assert set(b.path for b in s.all_buses) == {
+            ("bus.0",),
+            ("bus.0", "1F.ABCDEF.F1", "main"),
+            ("bus.0", "1F.ABCDEF.F1", "aux"),
+        }
+
+        # snapshots: changing the tree while iterating is safe
+        for b in s.all_buses:
+            for d in b.devices:
+                if d.id == "28.282828.28":
+                    await d.delocate(b)
+        dev = await ow.get_device("28.282828.28")
+        assert dev.bus is None
+        assert not ow.devices_behind("1F.ABCDEF.F1", "aux")
+        assert len(ow.devices_by_family(0x28)) == 1
+        assert not ow.devices_by_family(0x28, server=s)
+
+        # a rescan that finds new devices doesn't disturb the iteration
+        seen = []
+        for d in ow.devices_by_server(s):
+            my_tree["bus.0"]["1F.ABCDEF.F1"]["main"]["10.111111.11"] = {"some": "chip"}
+            await ow.scan_now(polling=False)
+            seen.append(d.id)
+        assert len(seen) == 3
+        assert len(s.devices) == 5
+        assert len(ow.devices_behind("1F.ABCDEF.F1", "main")) == 2
+
+        await s.aclose()
+        assert not s.devices
+        assert not s.all_buses
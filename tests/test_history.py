@@ -0,0 +1,57 @@
+import trio
+from copy import deepcopy
+
+from asyncowfs.history import RingBuffer
+from asyncowfs.mock import server, structs
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+basic_tree = {
+    "bus.0": {
+        "simultaneous": {"voltage": 0},
+        "10.345678.90": {"latesttemp": "12.5", "temphigh": "20", "templow": "15"},
+        "20.222222.22": {"latestvolt.ALL": "1.5,2.5,0,5"},
+    },
+    "structure": structs,
+}
+
+
+def test_ringbuffer():
+    buf = RingBuffer(4)
+    assert buf.latest() is None
+    assert buf.stats() is None
+    for i in range(6):
+        buf.append(i * 10, i)
+    assert len(buf) == 4
+    assert buf.latest() == (50, 5)
+    t, v = buf.last(3)
+    assert list(t) == [30, 40, 50]
+    assert list(v) == [3, 4, 5]
+    t, v = buf.range(15, 40)
+    assert list(v) == [2, 3, 4]
+    assert buf.stats() == dict(count=4, min=2, max=5, mean=3.5)
+    assert buf.stats(end=30) == dict(count=2, min=2, max=3, mean=2.5)
+
+
+async def test_history(mock_clock):
+    mock_clock.autojump_threshold = 0.1
+    my_tree = deepcopy(basic_tree)
+    vals = my_tree["bus.0"]["10.345678.90"]
+
+    async with server(tree=my_tree, history=3) as ow:
+        dev = await ow.get_device("10.345678.90")
+        vdev = await ow.get_device("20.222222.22")
+        await dev.set_polling_interval("temphigh", 10)
+        await vdev.set_polling_interval("voltage", 10)
+        for i in range(5):
+            vals["temphigh"] = str(20 + i)
+            await trio.sleep(10)
+
+        buf = ow.history.get(dev, "temphigh")
+        assert len(buf) == 3
+        assert list(buf.last(5)[1]) == [22, 23, 24]
+        assert buf.stats()["mean"] == 23
+        assert ow.history.get("20.222222.22", "voltage/1").latest()[1] == 2.5
+        assert ow.history.get(dev, "templow") is None
@@ -0,0 +1,132 @@
+import anyio
+import trio
+from copy import deepcopy
+
+from asyncowfs.event import DeviceValue, DeviceException, BusAdded
+from asyncowfs import journal
+from asyncowfs.journal import JournalWriter, read_journal, replay, ReplayedError, ReplayedBus
+from asyncowfs.mock import server, structs
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+basic_tree = {
+    "bus.0": {
+        "10.345678.90": {"latesttemp": "12.5", "temphigh": "20", "templow": "15"},
+        "20.222222.22": {"volt.ALL": "1.5,2.5,0,5"},
+    },
+    "structure": structs,
+}
+
+
+async def test_journal(mock_clock, tmp_path):
+    mock_clock.autojump_threshold = 0.1
+    base = str(tmp_path / "ow")
+    w = JournalWriter(base, max_size=600, keep=3)
+
+    async def rec(ow, evt):
+        await w.record(ow, evt)
+
+    async with server(tree=deepcopy(basic_tree), events=rec) as ow:
+        dev = await ow.get_device("10.345678.90")
+        vdev = await ow.get_device("20.222222.22")
+        await dev.set_polling_interval("temphigh", 10)
+        await vdev.set_polling_interval("volt_all", 10)
+        await trio.sleep(95)
+        await ow.push_event(DeviceException(dev, "templow", RuntimeError("gone")))
+        await trio.sleep(1)
+    assert w.records > 20
+
+    files = sorted(tmp_path.iterdir())
+    assert len(files) == 3  # rotated, old ones deleted
+    events = [e for f in files for e in read_journal(str(f))]
+    assert ("DeviceValue", [("device", "10.345678.90"), "temphigh", 20, 0]) in [
+        (name, fields[:3] + [0]) for _, name, fields in events
+    ]
+    assert [t for t, _, _ in events] == sorted(t for t, _, _ in events)
+
+    # replay into a fresh service
+    async with server(tree={}) as ow:
+        res = []
+
+        async with ow.subscribe(types=(DeviceValue, DeviceException, BusAdded)) as sub:
+            t = trio.current_time()
+            n = await replay(ow, base, speed=10)
+            assert n == len(events)
+            elapsed = trio.current_time() - t
+            assert abs(elapsed - (events[-1][0] - events[0][0]) / 10) < 0.1
+            while len(sub):
+                res.append(await sub.receive())
+
+    vals = [e for e in res if isinstance(e, DeviceValue)]
+    assert vals
+    assert all(e.device is ow._devices[e.device.id] for e in vals)
+    assert {e.attribute for e in vals} == {"temphigh", "volt_all"}
+    assert [1.5, 2.5, 0.0, 5.0] in [e.value for e in vals]
+    exc = [e for e in res if isinstance(e, DeviceException)][-1]
+    assert isinstance(exc.exception, ReplayedError)
+    assert exc.exception.name == "RuntimeError"
+    assert str(exc.exception) == "gone"
+
+
+def test_intern_full(tmp_path, monkeypatch):
+    monkeypatch.setattr(journal, "MAX_INTERN", 4)
+    base = str(tmp_path / "ow")
+    with JournalWriter(base) as w:
+        for i in range(10):
+            w.write(DeviceValue("10.345678.90", "attr%d" % i, i), i)
+        w.write(BusAdded(ReplayedBus(("bus.0",))), 10)
+    events = list(read_journal(base + ".0"))
+    assert [name for _, name, _ in events] == ["DeviceValue"] * 10 + ["BusAdded"]
+    assert [f[1] for _, _, f in events[:10]] == ["attr%d" % i for i in range(10)]
+
+
+async def test_tuple_attribute(mock_clock, tmp_path):
+    mock_clock.autojump_threshold = 0.1
+    base = str(tmp_path / "ow")
+    async with server(tree={}) as ow:
+        dev = await ow.get_device("20.222222.22")
+        with JournalWriter(base) as w:
+            w.write(DeviceValue(dev, ("volt", 0), 1.5), 0)
+            w.write(DeviceValue(dev, ("volt", 0), 2.5), 1)
+            w.write(DeviceValue(dev, "volt_all", [1.5, 2.5]), 2)
+
+        async with ow.subscribe(types=DeviceValue, policy="conflate") as sub:
+            assert await replay(ow, base, speed=None) == 3
+            res = [await sub.receive() for _ in range(len(sub))]
+    assert [(e.device, e.attribute, e.value) for e in res] == [
+        (dev, ("volt", 0), 2.5),
+        (dev, "volt_all", [1.5, 2.5]),
+    ]
+
+
+async def test_record_burst(mock_clock, tmp_path):
+    mock_clock.autojump_threshold = 0.1
+    base = str(tmp_path / "ow")
+    w = JournalWriter(base)
+    async with server(tree={}) as ow:
+        dev = await ow.get_device("10.345678.90")
+        async with trio.open_nursery() as n:
+            evt = anyio.create_event()
+            n.start_soon(w.record, ow, evt)
+            await evt.wait()
+            # the recorder gets these as one batch
+            times = []
+            for i in range(3):
+                times.append(trio.current_time())
+                await ow.push_event(DeviceValue(dev, "temphigh", i))
+                mock_clock.jump(1)
+            await trio.sleep(1)
+            n.cancel_scope.cancel()
+    events = [e for e in read_journal(base + ".0") if e[1] == "DeviceValue"]
+    assert [t for t, _, _ in events] == times
+
+    async with server(tree={}) as ow:
+        async with ow.subscribe(types=DeviceValue) as sub:
+            t = trio.current_time()
+            await replay(ow, base)
+            assert trio.current_time() - t == 2
+            assert len(sub) == 3
+            while len(sub):
+                await sub.receive()
@@ -0,0 +1,380 @@
+import pytest
+import trio
+from copy import deepcopy
+
+from asyncowfs.bus import BusBudgetExceeded, SPREAD_DELAY
+from asyncowfs.device import TemperatureBDevice
+from asyncowfs.event import DeviceValue
+from asyncowfs.mock import server, structs
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+basic_tree = {
+    "bus.0": {
+        "simultaneous": {"temperature": 0},
+        "10.345678.90": {
+            "latesttemp": "12.5",
+            "temperature": "12.5",
+            "templow": "15",
+            "temphigh": "20",
+        },
+        "10.345678.91": {
+            "latesttemp": "13.5",
+            "temperature": "13.5",
+            "templow": "15",
+            "temphigh": "20",
+        },
+    },
+    "structure": structs,
+}
+
+
+class Collector:
+    """Record all DeviceValue events"""
+
+    def __init__(self):
+        self.values = []
+
+    async def __call__(self, ow, evt):
+        async with ow.events as ev:
+            await evt.set()
+            async for e in ev:
+                if e is None:
+                    break
+                if isinstance(e, DeviceValue):
+                    self.values.append(e)
+
+
+async def test_scheduler(mock_clock):
+    mock_clock.autojump_threshold = 0.1
+    c = Collector()
+    async with server(tree=deepcopy(basic_tree), events=c, poll_workers=2) as ow:
+        ntasks = len(ow._tasks)
+        for d in ("10.345678.90", "10.345678.91"):
+            dev = await ow.get_device(d)
+            await dev.set_polling_interval("temphigh", 10)
+            await dev.set_polling_interval("templow", 10)
+        # one task for the scheduler, none per attribute
+        assert len(ow._tasks) == ntasks + 1
+        assert len(ow._poller) == 4
+
+        await trio.sleep(25)
+        res = [(v.device.id, v.attribute) for v in c.values]
+        assert len(set(res)) == 4
+        assert all(2 <= res.count(r) <= 3 for r in res)
+
+        await dev.set_polling_interval("templow", 0)
+        c.values = []
+        await trio.sleep(20)
+        res = [(v.device.id, v.attribute) for v in c.values]
+        assert ("10.345678.91", "templow") not in res
+        assert ("10.345678.91", "temphigh") in res
+        assert ("10.345678.90", "templow") in res
+
+
+async def test_no_drift(mock_clock):
+    mock_clock.autojump_threshold = 0.1
+    c = Collector()
+    times = []
+
+    async with server(tree=deepcopy(basic_tree), events=c) as ow:
+        dev = await ow.get_device("10.345678.90")
+        t0 = trio.current_time()
+        await dev.set_polling_interval("temphigh", 10)
+        job = dev._poll["temphigh"]
+
+        # every read takes three seconds
+        orig = dev.attr_get
+
+        async def slow_get(*a):
+            await trio.sleep(3)
+            times.append(trio.current_time() - t0)
+            return await orig(*a)
+
+        dev.attr_get = slow_get
+        await trio.sleep(40)
+        assert len(times) >= 3
+        assert all(round(b - a, 3) == 10 for a, b in zip(times, times[1:]))
+        assert job.skipped == 0
+
+        # now they take 25 seconds: deadlines are skipped, not queued
+        async def slower_get(*a):
+            await trio.sleep(25)
+            return await orig(*a)
+
+        dev.attr_get = slower_get
+        await trio.sleep(60)
+        assert job.skipped >= 2
+        assert all(v.late < 10 for v in c.values)
+
+
+async def test_spread(mock_clock):
+    mock_clock.autojump_threshold = 0.1
+    my_tree = deepcopy(basic_tree)
+    for i in range(2, 4):
+        my_tree["bus.0"]["10.345678.9%d" % i] = {"temphigh": "20", "templow": "15"}
+
+    async with server(tree=my_tree) as ow:
+        devs = [await ow.get_device("10.345678.9%d" % i) for i in range(4)]
+        for dev in devs:
+            await dev.set_polling_interval("temphigh", 10)
+        bus = devs[0].bus
+        await trio.sleep(SPREAD_DELAY + 0.1)
+        phases = sorted((dev._poll["temphigh"].deadline - bus._phase_base) % 10 for dev in devs)
+        assert phases == [0, 2.5, 5, 7.5]
+
+        # a device vanishes: the rest get rebalanced
+        del my_tree["bus.0"]["10.345678.93"]
+        for _ in range(4):
+            await ow.scan_now(polling=False)
+        assert devs[3].bus is None
+        phases = sorted(
+            round((dev._poll["temphigh"].deadline - bus._phase_base) % 10, 3) for dev in devs[:3]
+        )
+        assert phases == [0, 3.333, 6.667]
+
+
+async def test_backoff(mock_clock):
+    mock_clock.autojump_threshold = 0.1
+    times = []
+
+    async with server(tree=deepcopy(basic_tree), slow_poll=1) as ow:
+        dev = await ow.get_device("10.345678.90")
+        good = await ow.get_device("10.345678.91")
+        t0 = trio.current_time()
+        await dev.set_polling_interval("temphigh", 10)
+        await good.set_polling_interval("temphigh", 10)
+        job = dev._poll["temphigh"]
+        orig = dev.attr_get
+
+        async def bad_get(*a):  # pylint: disable=unused-argument
+            times.append(trio.current_time() - t0)
+            await trio.sleep(2)
+            raise RuntimeError("gone")
+
+        dev.attr_get = bad_get
+        await trio.sleep(100)
+        # intervals double: 20, 40 seconds
+        assert len(times) == 3
+        assert [round(b - a) for a, b in zip(times, times[1:])] == [20, 40]
+        assert job.errors == 3
+        assert job.slow
+        assert not good._poll["temphigh"].slow
+
+        # recovery restores the interval
+        dev.attr_get = orig
+        await trio.sleep(90)
+        assert job.errors == 0
+        n = job.skipped
+        t = job.deadline
+        await trio.sleep(30)
+        assert job.deadline == t + 30
+        assert job.skipped == n
+
+
+async def test_deadband(mock_clock):
+    mock_clock.autojump_threshold = 0.1
+    c = Collector()
+    my_tree = deepcopy(basic_tree)
+    vals = my_tree["bus.0"]["10.345678.90"]
+
+    async with server(tree=my_tree, events=c) as ow:
+        dev = await ow.get_device("10.345678.90")
+        await dev.set_polling_interval("temphigh", 10, deadband=1, heartbeat=60)
+        await dev.set_polling_interval("templow", 10, on_change=True)
+        await trio.sleep(35)
+        res = sorted((v.attribute, v.value) for v in c.values)
+        assert res == [("temphigh", 20), ("templow", 15)]
+        assert set(dev.suppressed) == {"temphigh", "templow"}
+        assert all(n >= 2 for n in dev.suppressed.values())
+
+        c.values = []
+        vals["temphigh"] = "20.5"  # within the deadband
+        vals["templow"] = "14"
+        await trio.sleep(10)
+        res = [(v.attribute, v.value) for v in c.values]
+        assert res == [("templow", 14)]
+
+        c.values = []
+        vals["temphigh"] = "21.5"
+        await trio.sleep(10)
+        res = [(v.attribute, v.value) for v in c.values]
+        assert res == [("temphigh", 21.5)]
+
+        # heartbeat
+        c.values = []
+        await trio.sleep(60)
+        res = [(v.attribute, v.value) for v in c.values]
+        assert res == [("temphigh", 21.5)]
+
+
+async def test_adaptive(mock_clock):
+    mock_clock.autojump_threshold = 0.1
+    my_tree = deepcopy(basic_tree)
+    vals = my_tree["bus.0"]["10.345678.90"]
+
+    async with server(tree=my_tree) as ow:
+        dev = await ow.get_device("10.345678.90")
+        await dev.set_polling_interval(
+            "temphigh", 10, min_interval=2, max_interval=20, step=1
+        )
+        assert dev.effective_interval("temphigh") == 10
+
+        # flat signal: the interval relaxes up to the maximum
+        await trio.sleep(200)
+        assert dev.effective_interval("temphigh") == 20
+        assert dev.polling_interval("temphigh") == 20
+
+        # fast signal: the interval tightens down to the minimum
+        async def ramp():
+            while True:
+                vals["temphigh"] = str(float(vals["temphigh"]) + 1)
+                await trio.sleep(1)
+
+        async with trio.open_nursery() as n:
+            n.start_soon(ramp)
+            await trio.sleep(80)
+            assert dev.effective_intervals == {"temphigh": 2}
+            n.cancel_scope.cancel()
+
+
+async def test_budget(mock_clock):
+    mock_clock.autojump_threshold = 0.1
+
+    # owserver takes a second to answer
+    async with server(tree=deepcopy(basic_tree), options={"slow_every": [0, 1]}) as ow:
+        devs = [await ow.get_device("10.345678.9%d" % i) for i in range(2)]
+        for dev in devs:
+            await dev.set_polling_interval("temphigh", 4)
+        bus = devs[0].bus
+        await trio.sleep(20)
+        assert 0.45 < bus.utilization < 0.55
+        assert bus.stretch == 1
+
+        bus.set_budget(0.25)
+        assert 1.8 < bus.stretch < 2.2
+        assert 7 < devs[0].effective_interval("temphigh") < 9
+
+        bus.set_budget(0.6, policy="refuse")
+        assert bus.stretch == 1
+        with pytest.raises(BusBudgetExceeded):
+            await devs[0].set_polling_interval("temphigh", 2)
+        await devs[0].set_polling_interval("temphigh", 3)
+        assert devs[0].effective_interval("temphigh") == 3
+
+
+async def test_budget_simul(mock_clock):
+    mock_clock.autojump_threshold = 0.1
+
+    # owserver takes 0.1s per request; the conversion doesn't use the bus
+    async with server(tree=deepcopy(basic_tree), options={"slow_every": [0, 0.1]}) as ow:
+        devs = [await ow.get_device("10.345678.9%d" % i) for i in range(2)]
+        for dev in devs:
+            await dev.set_polling_interval("temperature", 10)
+        bus = devs[0].bus
+        await trio.sleep(35)
+        job = bus._tasks["temperature"]
+        assert job.cost > 0.75 + 0.2
+        # one write, then both reads
+        assert job.bus_cost == pytest.approx(0.3)
+        assert bus.utilization == pytest.approx(0.03)
+
+
+async def test_snapshot(mock_clock):
+    mock_clock.autojump_threshold = 0.1
+    tree = deepcopy(basic_tree)
+    tree["bus.0"]["simultaneous"]["voltage"] = 0
+    tree["bus.0"]["20.222222.22"] = {"latestvolt.ALL": "1.5,2.5,0,5"}
+    del tree["bus.0"]["10.345678.91"]["latesttemp"]
+    async with server(tree=tree) as ow:
+        bus = ow.test_server._buses[("bus.0",)]
+        for d in ("10.345678.90", "10.345678.91", "20.222222.22"):
+            dev = await ow.get_device(d)
+            await ow.ensure_struct(dev)
+        t = trio.current_time()
+        snap = await bus.snapshot(["temperature", "voltage"])
+        assert trio.current_time() - t >= 0.75
+        assert tree["bus.0"]["simultaneous"] == {"temperature": "1", "voltage": "1"}
+
+        assert snap.ids == ["10.345678.90", "10.345678.91", "20.222222.22"]
+        assert len(snap) == 3
+        temp = snap["temperature"]
+        assert temp[0] == 12.5
+        assert temp[1] != temp[1] and temp[2] != temp[2]  # NaN
+        assert list(snap["voltage/1"])[2] == 2.5
+        assert snap.status[0] is None and snap.status[2] is None
+        assert snap.status[1] is not None
+
+        with pytest.raises(KeyError):
+            await bus.snapshot("humidity")
+
+
+async def test_ds18b20(mock_clock):
+    mock_clock.autojump_threshold = 0.1
+    pick = TemperatureBDevice.pick_resolution
+    assert pick() == 12
+    assert pick(0.25) == 10
+    assert pick(0.1) == 12
+    assert pick(0.2) == 11
+    assert pick(interval=1) == 11
+    assert pick(0.1, interval=0.3) == 9
+
+    tree = {
+        "bus.0": {
+            "simultaneous": {"temperature": 0},
+            "28.000000.01": {"latesttemp": "12.5", "temperature10": "12.25", "power": "1"},
+            "28.000000.02": {"latesttemp": "99", "temperature10": "14.75", "power": "0"},
+        },
+        "structure": structs,
+    }
+    c = Collector()
+    async with server(tree=tree, events=c) as ow:
+        bus = ow.test_server._buses[("bus.0",)]
+        devs = []
+        for d in ("28.000000.01", "28.000000.02"):
+            dev = await ow.get_device(d)
+            await ow.ensure_struct(dev)
+            await dev.set_polling_interval("temperature", 10, precision=0.25)
+            assert dev.resolution == 10
+            devs.append(dev)
+        await trio.sleep(25)
+
+        vals = {d: [e.value for e in c.values if e.device == d] for d in devs}
+        # the first poll sets the resolution, later ones use the simultaneous conversion
+        assert vals[devs[0]][:2] == [12.25, 12.5]
+        # parasite power: always converted by itself
+        assert set(vals[devs[1]]) == {14.75}
+        assert devs[0].simul_delay("temperature") == 0.188
+        assert devs[1].simul_delay("temperature") == 0
+        assert bus._simul_delay("temperature", devs) == 0.188
+
+        # unsetting the resolution goes back to plain simultaneous conversion
+        devs[0].set_resolution(None)
+        assert devs[0].simul_delay("temperature") is None
+        assert await devs[0].simul_temperature() == 12.5
+
+
+async def test_spread_many(mock_clock):
+    mock_clock.autojump_threshold = 0.1
+    n = 100
+    tree = {
+        "bus.0": {"10.345678.%03X" % i: {"temphigh": "20"} for i in range(n)},
+        "structure": structs,
+    }
+    async with server(tree=tree) as ow:
+        poller = ow._poller
+        seq = poller._seq
+        for dev in list(ow.devices):
+            await dev.set_polling_interval("temphigh", 10)
+        await trio.sleep(SPREAD_DELAY + 0.1)
+        # one push when adding each job, at most one more when spreading
+        assert poller._seq - seq <= 2 * n
+        assert len(poller._heap) <= 2 * n
+        bus = ow.test_server._buses[("bus.0",)]
+        phases = sorted(
+            round((dev._poll["temphigh"].deadline - bus._phase_base) % 10, 3)
+            for dev in ow.devices
+        )
+        assert phases == [round(i * 10 / n, 3) for i in range(n)]
@@ -0,0 +1,32 @@
+from asyncowfs.protocol import MessageQueue, AttrGetMsg, NOPMsg
+
+MAIN = ("bus.0", "1F.ABCDEF.F1", "main")
+AUX = ("bus.0", "1F.ABCDEF.F1", "aux")
+
+
+async def test_branch():
+    assert AttrGetMsg(*MAIN, "20.222222.22", "volt.A").branch == MAIN
+    assert AttrGetMsg(*AUX, "1F.123456.78", "aux", "10.1.2", "x").branch == AUX + (
+        "1F.123456.78",
+        "aux",
+    )
+    assert AttrGetMsg("bus.0", "10.345678.90", "aux").branch == ()
+    assert NOPMsg().branch == ()
+
+
+async def test_grouping():
+    q = MessageQueue(max_burst=3)
+    msgs = []
+    for i in range(4):
+        msgs.append(AttrGetMsg(*MAIN, "20.222222.22", str(i)))
+        msgs.append(AttrGetMsg(*AUX, "28.282828.28", str(i)))
+    for m in msgs:
+        await q.send(m)
+    assert len(q) == 8
+
+    res = [await q.receive() for _ in range(8)]
+    assert [m.branch for m in res] == [MAIN] * 3 + [AUX] * 3 + [MAIN] + [AUX]
+    # same-branch requests keep their order
+    assert [m.path[-1] for m in res if m.branch == MAIN] == ["0", "1", "2", "3"]
+    assert q.switches == 3
+    assert not len(q)
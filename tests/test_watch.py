@@ -0,0 +1,99 @@
+import anyio
+import trio
+from copy import deepcopy
+
+from asyncowfs.mock import server, structs
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+basic_tree = {
+    "bus.0": {"10.345678.90": {"latesttemp": "12.5", "temperature": "12.5", "templow": "15"}},
+    "structure": structs,
+}
+
+
+async def test_watch(mock_clock):
+    mock_clock.autojump_threshold = 0.1
+    tree = deepcopy(basic_tree)
+    dev_tree = tree["bus.0"]["10.345678.90"]
+    async with server(tree=tree) as ow:
+        dev = await ow.get_device("10.345678.90")
+        await ow.ensure_struct(dev)
+        await dev.wait_bus()
+        fast = []
+        slow = []
+
+        async def watcher(interval, res, n):
+            async with dev.watch("temperature", interval) as w:
+                async for v in w:
+                    res.append((trio.current_time(), v))
+                    if len(res) == n:
+                        break
+
+        t0 = trio.current_time()
+        async with anyio.create_task_group() as tg:
+            await tg.spawn(watcher, 30, slow, 3)
+            await trio.sleep(1)
+            assert dev._watches[("temperature",)][0].interval == 30
+            await tg.spawn(watcher, 10, fast, 5)
+            await trio.sleep(1)
+            job = dev._watches[("temperature",)][0]
+            assert job.interval == 10
+            dev_tree["temperature"] = "13.5"
+            await trio.sleep(45)
+            # the fast watcher is done, the slow one still watches
+            assert len(fast) == 5
+            assert job.interval == 30
+
+        assert [v for _, v in fast][-1] == 13.5
+        assert [v for _, v in slow] == [12.5, 13.5, 13.5]
+        # the slow watcher gets a value at most every 30 seconds
+        times = [t for t, _ in slow]
+        assert all(b - a >= 30 for a, b in zip(times, times[1:]))
+        assert times[0] - t0 < 1
+        # the poll stops when nobody watches
+        assert not dev._watches
+        assert job.cancelled
+
+
+async def test_watch_relocate(mock_clock):
+    mock_clock.autojump_threshold = 0.1
+    async with server(tree=deepcopy(basic_tree)) as ow:
+        dev = await ow.get_device("10.345678.90")
+        await ow.ensure_struct(dev)
+        await dev.wait_bus()
+        bus = dev.bus
+        res = []
+
+        async def watcher(path):
+            async with dev.watch(path, 10) as w:
+                async for v in w:
+                    res.append((path, v))
+
+        async with anyio.create_task_group() as tg:
+            await tg.spawn(watcher, "temperature")
+            await trio.sleep(1)
+            job = dev._watches[("temperature",)][0]
+            assert job.bus is bus
+
+            # the poll is paused while the device is gone
+            await dev.delocate(bus)
+            assert job.cancelled
+            assert dev._watches[("temperature",)][0] is None
+            # a watch that starts meanwhile waits too
+            await tg.spawn(watcher, "templow")
+            await trio.sleep(30)
+            assert dev._watches[("templow",)][0] is None
+            assert res == [("temperature", 12.5)]
+
+            await bus.add_device(dev)
+            await trio.sleep(1)
+            for path in ("temperature", "templow"):
+                job = dev._watches[(path,)][0]
+                assert job.bus is bus
+                assert not job.cancelled
+            assert sorted(res) == [("temperature", 12.5), ("temperature", 12.5), ("templow", 15)]
+            await tg.cancel_scope.cancel()
+        assert len(ow._poller) == 0
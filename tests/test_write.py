@@ -0,0 +1,170 @@
+import anyio
+import pytest
+import trio
+from copy import deepcopy
+
+from asyncowfs.mock import server, structs
+from asyncowfs.protocol import AttrSetMsg
+from asyncowfs.server import WriteBufferFull
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+basic_tree = {
+    "bus.0": {"10.345678.90": {"latesttemp": "12.5", "temphigh": "20", "templow": "15"}},
+    "structure": structs,
+}
+
+
+async def disconnect(s, close):
+    """Make the mock server drop the connection and refuse new ones.
+    The connection is dropped when the next request arrives."""
+    close[1] = True
+    while s._online:
+        await trio.sleep(1)
+
+
+async def reconnect(s, close):
+    close[1] = False
+    while not s._online:
+        await trio.sleep(0.1)
+
+
+async def test_coalesce(mock_clock):
+    mock_clock.autojump_threshold = 0.1
+    tree = deepcopy(basic_tree)
+    dev_tree = tree["bus.0"]["10.345678.90"]
+    async with server(tree=tree) as ow:
+        dev = await ow.get_device("10.345678.90")
+        await ow.ensure_struct(dev)
+        await dev.wait_bus()
+        c = dev.set_write_coalescing("temphigh", spacing=1)
+        done = []
+
+        async def setter(v):
+            await dev.set_temphigh(v)
+            done.append(v)
+
+        async with anyio.create_task_group() as tg:
+            for v in range(30, 40):
+                await tg.spawn(setter, v)
+                await trio.sleep(0.01)
+        assert sorted(done) == list(range(30, 40))
+        assert dev_tree["temphigh"] == "39"
+        # the first write goes out at once, the others wait for it
+        assert c.writes == 2
+        assert c.coalesced == 8
+
+        # spacing
+        t = trio.current_time()
+        await dev.set("temphigh", value=41)
+        await dev.set_temphigh(42)
+        assert trio.current_time() - t >= 1
+        assert dev_tree["temphigh"] == "42"
+
+        # other attributes are not affected
+        await dev.set_templow(10)
+        assert dev_tree["templow"] == "10"
+
+        dev.set_write_coalescing("temphigh", enable=False)
+        await dev.set_temphigh(43)
+        assert c.writes == 4
+        assert dev_tree["temphigh"] == "43"
+
+
+async def test_offline(mock_clock):
+    mock_clock.autojump_threshold = 0.1
+    tree = deepcopy(basic_tree)
+    dev_tree = tree["bus.0"]["10.345678.90"]
+    close = [0, False]
+    async with server(tree=tree, options={"close_every": close}) as ow:
+        dev = await ow.get_device("10.345678.90")
+        await ow.ensure_struct(dev)
+        await dev.wait_bus()
+        s = ow.test_server
+        s.offline_writes = 3
+        sent = []
+        submit = s.submit
+
+        async def rec_submit(msg):
+            if isinstance(msg, AttrSetMsg):
+                sent.append(msg.data)
+            await submit(msg)
+
+        s.submit = rec_submit
+
+        await disconnect(s, close)
+        done = []
+        errors = []
+
+        async def setter(v):
+            await dev.attr_set("temphigh", value=v)
+            done.append(v)
+
+        async with anyio.create_task_group() as tg:
+            await tg.spawn(setter, 30)
+            await trio.sleep(0.01)
+            await tg.spawn(setter, 31)
+            await trio.sleep(0.01)
+            await dev.attr_set("templow", value=10, wait=False)
+            await dev.attr_set("alias", value=1, wait=False, priority=1, on_error=errors.append)
+            with pytest.raises(WriteBufferFull):
+                await dev.attr_set("power", value=1, wait=False)
+            await trio.sleep(1)
+            assert not sent
+            assert dev_tree["temphigh"] == "20"
+            assert not errors
+            await reconnect(s, close)
+
+        assert sorted(done) == [30, 31]
+        assert dev_tree["temphigh"] == "31"
+        assert dev_tree["templow"] == "10"
+        assert len(errors) == 1
+        # coalesced by path, priority first
+        names = [d.split(b"/")[-1].split(b"\0")[0] for d in sent]
+        assert names == [b"alias", b"temphigh", b"templow"]
+
+        # online again
+        await dev.attr_set("temphigh", value=32, wait=False)
+        await trio.sleep(1)
+        assert dev_tree["temphigh"] == "32"
+
+
+async def test_offline_many(mock_clock):
+    mock_clock.autojump_threshold = 0.1
+    tree = deepcopy(basic_tree)
+    dev_tree = tree["bus.0"]["10.345678.90"]
+    close = [0, False]
+    async with server(tree=tree, options={"close_every": close}) as ow:
+        dev = await ow.get_device("10.345678.90")
+        await ow.ensure_struct(dev)
+        await dev.wait_bus()
+        s = ow.test_server
+        s.offline_writes = 2
+        await disconnect(s, close)
+        res = []
+
+        async def writer():
+            res.extend(
+                await ow.write_many(
+                    [(dev, "temphigh", 30), (dev, "templow", 10), (dev, "temphigh", 31)]
+                )
+            )
+
+        async with anyio.create_task_group() as tg:
+            await tg.spawn(writer)
+            await trio.sleep(1)
+            # buffered and coalesced, not blocked
+            assert set(s._offline) == {
+                ("bus.0", "10.345678.90", "temphigh"),
+                ("bus.0", "10.345678.90", "templow"),
+            }
+            assert dev_tree["temphigh"] == "20"
+            r = await ow.write_many([(dev, "alias", "x")])
+            assert isinstance(r[0], WriteBufferFull)
+            await reconnect(s, close)
+
+        assert res == [None, None, None]
+        assert dev_tree["temphigh"] == "31"
+        assert dev_tree["templow"] == "10"